@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+"""
+Annotation index of features by genomic position:
+sorted step boundaries per chromosome and strand in NumPy arrays,
+with an integer id of the feature set of each step
+"""
+
+import os
+import cPickle
+from bisect import bisect_right
+from collections import defaultdict
+import numpy as np
+
+################################################################################
+
+class FeatureSets(list):
+    """
+    List of feature sets, stored tuples (of loaded index) are made
+    frozensets at first access
+    """
+    def __getitem__(self, i):
+        fs = list.__getitem__(self, i)
+        if type(fs) is tuple:
+            fs = frozenset(fs)
+            list.__setitem__(self, i, fs)
+        return fs
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+################################################################################
+
+class AnnotIndex(object):
+    """
+    Steps of features per (chrom, strand): bounds[i] <= pos < bounds[i+1]
+    is step i with feature set id setids[i], positions outside the bounds
+    have no feature. Feature sets are interned, id 0 is the empty set,
+    intersections of sets are cached by pair of ids.
+    Ids of sets interned by lookups (intersections) are local to the
+    process, pass counts by id to other processes as sets (see to_sets).
+    """
+    def __init__(self):
+        self.chroms = set()
+        self.fsets = FeatureSets([frozenset()])
+        self.fset2id = {frozenset():0} # None until needed for loaded index
+        self.key2bounds = {}
+        self.key2setids = {}
+        self.inter_cache = {}
+
+    @classmethod
+    def build(cls, intervals, chroms=()):
+        """
+        Build index of given intervals (chrom, start, end, strand, feature),
+        0-based and end exclusive
+        chroms: chromosomes without feature in intervals but known
+        """
+        index = cls()
+        index.chroms.update(chroms)
+        key2events = defaultdict(list)
+        for chrom, start, end, strand, feature in intervals:
+            index.chroms.add(chrom)
+            if start < end:
+                key2events[(chrom, strand)].append((start, 1, feature))
+                key2events[(chrom, strand)].append((end, -1, feature))
+        for key, events in key2events.iteritems():
+            index.add_steps(key, events)
+        return index
+
+    def intern(self, fset):
+        """Return id of given frozenset of features"""
+        if self.fset2id is None:
+            self.fset2id = dict((fs, i) for i, fs in enumerate(self.fsets))
+        fsid = self.fset2id.get(fset)
+        if fsid is None:
+            fsid = self.fset2id[fset] = len(self.fsets)
+            self.fsets.append(fset)
+        return fsid
+
+    def add_steps(self, key, events):
+        """Sweep (position, +1/-1, feature) events of key to steps"""
+        events.sort()
+        active = defaultdict(int)
+        bounds = []
+        setids = []
+        i = 0
+        while i < len(events):
+            pos = events[i][0]
+            while i < len(events) and events[i][0] == pos:
+                _, delta, feature = events[i]
+                active[feature] += delta
+                if not active[feature]:
+                    del active[feature]
+                i += 1
+            fsid = self.intern(frozenset(active))
+            if setids and setids[-1] == fsid:
+                continue # same set as previous step
+            bounds.append(pos)
+            setids.append(fsid)
+        # last step ends at last bound with empty set
+        self.key2bounds[key] = np.array(bounds, dtype=np.int64)
+        self.key2setids[key] = np.array(setids[:-1], dtype=np.int32)
+
+    def intersect(self, id1, id2):
+        """
+        Return id of intersection of two feature sets by ids,
+        a new set is interned in this process only
+        """
+        if id1 == id2:
+            return id1
+        if id1 > id2:
+            id1, id2 = id2, id1
+        if id1 == 0:
+            return 0
+        fsid = self.inter_cache.get((id1, id2))
+        if fsid is None:
+            fsid = self.intern(self.fsets[id1] & self.fsets[id2])
+            self.inter_cache[(id1, id2)] = fsid
+        return fsid
+
+    def to_sets(self, fsid2count):
+        """Return dict of feature set to count from dict of id to count"""
+        return dict((self.fsets[fsid], num) 
+            for fsid, num in fsid2count.iteritems())
+
+    def from_sets(self, fset2count):
+        """Return dict of id to count from dict of feature set to count"""
+        fsid2count = defaultdict(int)
+        for fset, num in fset2count.iteritems():
+            fsid2count[self.intern(fset)] += num
+        return dict(fsid2count)
+
+    def lookup(self, chrom, strand, start, end):
+        """
+        Return id of the intersection of feature sets of all positions
+        in [start, end), 0 if any position has no feature or range is empty
+        """
+        bounds = self.key2bounds.get((chrom, strand))
+        if bounds is None or start >= end or start < bounds[0] or \
+                end > bounds[-1]:
+            return 0
+        i = int(bounds.searchsorted(start, 'right')) - 1
+        j = int(bounds.searchsorted(end, 'left'))
+        setids = self.key2setids[(chrom, strand)]
+        fsid = int(setids[i])
+        for k in xrange(i + 1, j):
+            fsid = self.intersect(fsid, int(setids[k]))
+            if fsid == 0:
+                break
+        return fsid
+
+    def lookup_points(self, chrom, strand, positions):
+        """
+        Return array of feature set ids of given positions (array-like),
+        0 for positions without feature
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        fsids = np.zeros(len(positions), dtype=np.int32)
+        bounds = self.key2bounds.get((chrom, strand))
+        if bounds is None or len(positions) == 0:
+            return fsids
+        idx = bounds.searchsorted(positions, 'right') - 1
+        inside = (idx >= 0) & (idx < len(bounds) - 1)
+        fsids[inside] = self.key2setids[(chrom, strand)][idx[inside]]
+        return fsids
+
+    def lookup_blocks(self, blocks):
+        """
+        Return id of features overlapping all given blocks
+        (chrom, strand, start, end) in intersection-strict mode,
+        blocks on chromosomes not in index are skipped, None if no block
+        """
+        fsid = None
+        for chrom, strand, start, end in blocks:
+            if chrom not in self.chroms:
+                continue
+            bid = self.lookup(chrom, strand, start, end)
+            fsid = bid if fsid is None else self.intersect(fsid, bid)
+        return fsid
+
+    def steps(self):
+        """Generator of (chrom, strand, start, end, feature set) of steps"""
+        for key in sorted(self.key2bounds):
+            bounds = self.key2bounds[key]
+            setids = self.key2setids[key]
+            for i in xrange(len(setids)):
+                yield (key[0], key[1], int(bounds[i]), int(bounds[i+1]),
+                    self.fsets[setids[i]])
+
+    def regions(self, gap=0):
+        """
+        Return dict of chrom to sorted list of (start, end) of merged 
+        regions having features on either strand (see merge_regions)
+        """
+        chrom2ivals = defaultdict(list)
+        for (chrom, strand), bounds in self.key2bounds.iteritems():
+            idx = np.flatnonzero(self.key2setids[(chrom, strand)])
+            chrom2ivals[chrom].extend(zip(bounds[idx].tolist(), 
+                bounds[idx+1].tolist()))
+        return dict((chrom, merge_regions(ivals, gap)) 
+            for chrom, ivals in chrom2ivals.iteritems())
+
+    def save(self, dirname):
+        """
+        Save index to directory: step arrays of all keys concatenated in
+        bounds.npy and setids.npy, keys, chromosomes and sets in annot.pkl
+        """
+        keys = sorted(self.key2bounds)
+        offsets = [0]
+        for key in keys:
+            offsets.append(offsets[-1] + len(self.key2bounds[key]))
+        bounds = [self.key2bounds[key] for key in keys]
+        setids = [np.append(self.key2setids[key], 0).astype(np.int32) 
+            for key in keys]
+        np.save(os.path.join(dirname, 'bounds.npy'), 
+            np.concatenate(bounds) if keys else np.zeros(0, dtype=np.int64))
+        np.save(os.path.join(dirname, 'setids.npy'), 
+            np.concatenate(setids) if keys else np.zeros(0, dtype=np.int32))
+        with open(os.path.join(dirname, 'annot.pkl'), 'wb') as oh:
+            cPickle.dump({'keys':keys, 'offsets':offsets, 'chroms':self.chroms,
+                'fsets':[tuple(fs) for fs in list.__iter__(self.fsets)]}, 
+                oh, cPickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, dirname):
+        """
+        Load index saved to directory, step arrays memory-mapped,
+        feature sets made at first use
+        """
+        with open(os.path.join(dirname, 'annot.pkl'), 'rb') as fh:
+            meta = cPickle.load(fh)
+        bounds = np.asarray(np.load(os.path.join(dirname, 'bounds.npy'), 
+            mmap_mode='r'))
+        setids = np.asarray(np.load(os.path.join(dirname, 'setids.npy'), 
+            mmap_mode='r'))
+        index = cls()
+        index.chroms = meta['chroms']
+        index.fsets = FeatureSets(meta['fsets'])
+        index.fset2id = None
+        offsets = meta['offsets']
+        for i, key in enumerate(meta['keys']):
+            # last step id of a key is a placeholder for the last bound
+            index.key2bounds[key] = bounds[offsets[i]:offsets[i+1]]
+            index.key2setids[key] = setids[offsets[i]:offsets[i+1]-1]
+        return index
+
+################################################################################
+
+def merge_regions(ivals, gap=0):
+    """
+    Return sorted list of (start, end) merged from given intervals,
+    also merged if not farther apart than gap
+    """
+    regions = []
+    for start, end in sorted(ivals):
+        if regions and start <= regions[-1][1] + gap:
+            regions[-1][1] = max(regions[-1][1], end)
+        else:
+            regions.append([start, end])
+    return [tuple(r) for r in regions]
+
+################################################################################
+
+class StepCursor(object):
+    """
+    Sweep line over steps of one (chrom, strand) of AnnotIndex for reads
+    in ascending order of start: the current step only moves forward,
+    so a lookup costs amortized O(1) instead of a search
+    """
+    def __init__(self, index, chrom, strand):
+        self.index = index
+        bounds = index.key2bounds.get((chrom, strand))
+        if bounds is None:
+            self.bounds = []
+            self.setids = []
+        else:
+            self.bounds = bounds.tolist()
+            self.setids = index.key2setids[(chrom, strand)].tolist()
+        self.i = 0
+
+    def lookup(self, start, end, advance=True):
+        """
+        Return id of the intersection of feature sets of all positions
+        in [start, end) as AnnotIndex.lookup
+        advance: move current step to start, starts of later lookups 
+            should not be less (otherwise searched from the beginning)
+        """
+        bounds = self.bounds
+        if not bounds or start < bounds[0] or end > bounds[-1]:
+            return 0
+        i = self.i
+        if start < bounds[i]:
+            i = bisect_right(bounds, start) - 1
+        elif not advance:
+            i = bisect_right(bounds, start, i) - 1
+        else:
+            while bounds[i+1] <= start:
+                i += 1
+        if advance:
+            self.i = i
+        setids = self.setids
+        fsid = setids[i]
+        i += 1
+        while bounds[i] < end and fsid:
+            fsid = self.index.intersect(fsid, setids[i])
+            i += 1
+        return fsid
+
+    def lookup_blocks(self, blocks):
+        """
+        Return id of features overlapping all (start, end) blocks of a read,
+        current step is moved to the first block
+        """
+        start, end = blocks[0]
+        fsid = self.lookup(start, end)
+        for start, end in blocks[1:]:
+            if not fsid:
+                break
+            fsid = self.index.intersect(fsid, self.lookup(start, end, False))
+        return fsid
+
+################################################################################
@@ -3,8 +3,17 @@
 Module for decoding multiplex barcodes
 """
 
+import os
 import sys
-from maps.io_utils.fastq import reader_fastq
+import time
+import json
+import multiprocessing
+from collections import defaultdict
+from itertools import combinations, product
+import numpy as np
+from maps.utils import TopKSketch, iter_batches
+from maps.io_utils.fastq import reader_fastq, split_fastq, sample_fastq
+from maps.io_utils.outpool import OutputPool
 
 ################################################################################
 
@@ -28,6 +37,174 @@ def barcode_distance(str_a, str_b):
     return sum([1 for i in xrange(len(str_a)) if str_a[i] != str_b[i]])
 
 ################################################################################
+
+def barcode_neighbors(barcode, mismatch, alphabet='ACGTN'):
+    """
+    Generate (sequence, distance) for all sequences within given mismatch
+    of barcode, each sequence exactly once at its distance
+    """
+    for dist in xrange(mismatch+1):
+        for poss in combinations(xrange(len(barcode)), dist):
+            subs = [[c for c in alphabet if c != barcode[i]] for i in poss]
+            for chars in product(*subs):
+                seq = list(barcode)
+                for i, c in zip(poss, chars):
+                    seq[i] = c
+                yield ''.join(seq), dist
+
+################################################################################
+
+def barcode_neighborhood(barcodes, mismatch, alphabet='ACGTN'):
+    """
+    Return dict of sequence:(barcode, distance) for all sequences within
+    given mismatch of any barcode. Only the closest barcode is kept, and
+    barcode is None if several barcodes are equally close (ambiguous)
+    """
+    seq2hit = {}
+    for bc in barcodes:
+        for seq, dist in barcode_neighbors(bc, mismatch, alphabet):
+            if seq not in seq2hit:
+                seq2hit[seq] = (bc, dist)
+                continue
+            hit_bc, hit_dist = seq2hit[seq]
+            if dist < hit_dist:
+                seq2hit[seq] = (bc, dist)
+            elif dist == hit_dist and hit_bc != bc:
+                seq2hit[seq] = (None, dist)
+    
+    return seq2hit
+
+################################################################################
+
+class BarcodeTable(object):
+    """
+    Lookup table of sequences within mismatch of a set of same-length barcodes
+    """
+    ALPHABET = 'ACGTN'
+    
+    def __init__(self, barcodes, mismatch):
+        self.barcodes = sorted(barcodes)
+        self.mismatch = mismatch
+        self.lenbc = len(self.barcodes[0])
+        self.alphabet = ''.join(sorted(set(BarcodeTable.ALPHABET + 
+            ''.join(self.barcodes))))
+        self.seq2hit = barcode_neighborhood(self.barcodes, mismatch, 
+            self.alphabet)
+    
+    def lookup(self, seq):
+        """
+        Return (barcode, distance) of the closest barcode within mismatch,
+        barcode is None if ambiguous, and (None, None) if no one found
+        """
+        hit = self.seq2hit.get(seq)
+        if hit is not None:
+            return hit
+        if len(seq) != self.lenbc or not seq.translate(None, self.alphabet):
+            return (None, None)
+        # characters out of alphabet are not in table, scan all barcodes
+        dists = [(barcode_distance(bc, seq), bc) for bc in self.barcodes]
+        min_dist = min(dists)[0]
+        if min_dist > self.mismatch:
+            return (None, None)
+        bc_mindist = [bc for (d, bc) in dists if d == min_dist]
+        if len(bc_mindist) > 1:
+            return (None, min_dist)
+        return (bc_mindist[0], min_dist)
+
+################################################################################
+
+class DecodeStats(object):
+    """
+    Decoding telemetry: reads per barcode, histogram of mismatch distances,
+    ambiguous and failed reads, most common sequences not decoded
+    """
+    def __init__(self, capacity=1000):
+        """capacity: counters of sketch for sequences not decoded"""
+        self.barcode2count = defaultdict(int)
+        self.dist2count = defaultdict(int)
+        self.nambiguous = 0
+        self.nfailed = 0
+        self.failed_seqs = TopKSketch(capacity)
+        self.seconds = 0.0
+        self.counters = defaultdict(int)
+        self.hists = {}
+    
+    @property
+    def numread(self):
+        return sum(self.barcode2count.itervalues()) + \
+            self.nambiguous + self.nfailed
+    
+    def add(self, seq, bc, dist):
+        """Add one read of barcode sequence and its (barcode, distance)"""
+        if bc is not None:
+            self.barcode2count[bc] += 1
+            self.dist2count[dist] += 1
+            return
+        if dist is None:
+            self.nfailed += 1
+        else:
+            self.nambiguous += 1
+        if not isinstance(seq, str):
+            seq = '+'.join(seq)
+        self.failed_seqs.add(seq)
+    
+    def incr(self, name, num=1):
+        """Increase counter of given name, e.g. reads dropped by a stage"""
+        self.counters[name] += num
+    
+    def hist(self, name, value):
+        """Add one value to histogram of given name"""
+        if name not in self.hists:
+            self.hists[name] = defaultdict(int)
+        self.hists[name][value] += 1
+    
+    def merge(self, other):
+        """Merge stats of another part of reads"""
+        for bc, cnt in other.barcode2count.iteritems():
+            self.barcode2count[bc] += cnt
+        for dist, cnt in other.dist2count.iteritems():
+            self.dist2count[dist] += cnt
+        self.nambiguous += other.nambiguous
+        self.nfailed += other.nfailed
+        self.failed_seqs.merge(other.failed_seqs)
+        for name, cnt in other.counters.iteritems():
+            self.counters[name] += cnt
+        for name, hist in other.hists.iteritems():
+            if name not in self.hists:
+                self.hists[name] = defaultdict(int)
+            for value, cnt in hist.iteritems():
+                self.hists[name][value] += cnt
+    
+    def as_dict(self, barcode2name, topk=20):
+        """Return dict of stats, samples named as in barcode2name"""
+        numread = self.numread
+        return {
+            'reads': numread,
+            'samples': dict((name, {'barcode':bc, 
+                'reads':self.barcode2count.get(bc, 0)}) 
+                for bc, name in barcode2name.iteritems()),
+            'mismatch': dict((str(d), cnt) 
+                for d, cnt in self.dist2count.iteritems()),
+            'ambiguous': self.nambiguous,
+            'failed': self.nfailed,
+            'top_failed': self.failed_seqs.top(topk),
+            'seconds': round(self.seconds, 3),
+            'reads_per_sec': round(numread / self.seconds, 1) 
+                if self.seconds > 0 else None,
+            'counters': dict(self.counters),
+            'hists': dict((name, dict((str(v), cnt) 
+                    for v, cnt in hist.iteritems()))
+                for name, hist in self.hists.iteritems()),
+            }
+    
+    def write(self, outfile, barcode2name, topk=20):
+        """Write stats in JSON"""
+        with open(outfile, 'w') as oh:
+            json.dump(self.as_dict(barcode2name, topk), oh, 
+                indent=2, sort_keys=True)
+            oh.write('\n')
+
+################################################################################
     
 def decode_fastq(infile, barcode2name, mismatch=0, startpos=37, outprefix=None):
     """
@@ -70,15 +247,24 @@ class Decoder(object):
     Use DecorderExact if no mismatch allowed
     """
     def __init__(self, infile, barcode2name, 
-        mismatch=1, startpos=37, outprefix=None):
+        mismatch=1, startpos=37, outprefix=None, compress=False, max_open=256,
+        stages=None, dry_run=False):
         """
         barcode2name: a dict for barcode:samplename
         mismatch: maximum allowed mismatch
         startpos: 1-based start position
+        compress: write outputs in BGZF (.gz)
+        max_open: maximum number of output files open at the same time
+        stages: list of pipeline stages applied to decoded reads before
+            writing (see maps.pipeline)
+        dry_run: no output file is opened, only decode_sample is used
         """
         self.infile = infile
         self.barcode2name = barcode2name
         self.mismatch = mismatch
+        self.compress = compress
+        self.max_open = max_open
+        self.stages = stages or []
         self.startpos = startpos - 1
         assert self.startpos >= 0, "given start position should be 1-based"
         
@@ -89,14 +275,28 @@ class Decoder(object):
         self.lenbc = self.check_barcode_len()
         assert not self.lenbc is None, "No barcode"
             
-        self.barcode2outhandle = {
-            'failed':open(self.outprefix+'.failed.m'+str(mismatch), 'w'),
-        }
-        
-        for bc in self.barcode2name:
-            outfile = self.outprefix+'.'+self.barcode2name[bc]+'.m'+str(self.mismatch)
-            self.barcode2outhandle[bc] = open(outfile, 'w')
-        #capture IOError if too many out-handles at the same time (>=1021) 
+        self.outpool = None
+        if not dry_run:
+            self.outpool = self.open_outpool(self.outprefix)
+    
+    def outfile(self, bc, outprefix):
+        """Return output file name of given barcode or 'failed'"""
+        name = self.barcode2name.get(bc, bc)
+        outfile = outprefix+'.'+name+'.m'+self.mismatch_tag()
+        if self.compress:
+            outfile += '.gz'
+        return outfile
+    
+    def mismatch_tag(self):
+        """Return allowed mismatch as in output file names"""
+        return str(self.mismatch)
+    
+    def open_outpool(self, outprefix):
+        """Return OutputPool of outputs by barcode including 'failed'"""
+        outpool = OutputPool(max_open=self.max_open)
+        for bc in ['failed'] + self.barcode2name.keys():
+            outpool.add(bc, self.outfile(bc, outprefix))
+        return outpool
         
     def check_barcode_len(self):
         """
@@ -111,25 +311,112 @@ class Decoder(object):
             assert bl == bclen
         return bclen
 
-    def decode(self):
-        """decode and write results"""
-        for record in reader_fastq(self.infile):
-            fqseq = record.get_seq() 
-            currseq = fqseq[self.startpos:(self.startpos+self.lenbc)]
-            if len(currseq) < self.lenbc:
-                sys.stderr.write("%s not have enough length" % currseq)
-            
-            bc = self.decode_one(currseq)
-            self.barcode2outhandle[bc].write("%s\n" % str(record))
-
-        for oh in self.barcode2outhandle.values():
-            oh.close()
+    def decode(self, threads=1):
+        """
+        decode and write results, stats are written to outprefix.decode.json
+        threads: number of worker processes
+        """
+        assert self.outpool is not None, \
+            "no output files of dry run decoder, use decode_sample"
+        start = time.time()
+        if threads > 1:
+            self.stats = self.decode_parallel(threads)
+        else:
+            self.stats = self.decode_records(reader_fastq(self.infile), 
+                self.outpool)
+        
+        self.outpool.close()
+        self.stats.seconds = time.time() - start
+        self.stats.write(self.outprefix+'.decode.json', self.barcode2name)
+    
+    def decode_records(self, records, outpool):
+        """
+        decode given Fastq records, pass them through stages, 
+        write to OutputPool, return stats
+        """
+        stats = DecodeStats()
+        for bc, record in self.iter_staged(records, stats):
+            outpool.write(bc, record.as_raw())
+        return stats
+    
+    def iter_staged(self, records, stats):
+        """Generator of (barcode or 'failed', record) after all stages"""
+        items = self.iter_decoded(records, stats)
+        for stage in self.stages:
+            items = stage(items, stats)
+        return items
+    
+    def decode_sample(self, count=None, fraction=None, seed=0):
+        """
+        Dry run: decode randomly sampled reads (see sample_fastq) 
+        through stages without writing, return stats 
+        with histogram 'length' of decoded read lengths after stages
+        """
+        start = time.time()
+        stats = DecodeStats()
+        records = sample_fastq(self.infile, fraction, count, seed)
+        for bc, record in self.iter_staged(records, stats):
+            if bc != "failed":
+                stats.hist('length', record.get_length())
+        stats.seconds = time.time() - start
+        self.stats = stats
+        return stats
+    
+    def iter_decoded(self, records, stats):
+        """Generator of (barcode or 'failed', record), add to stats"""
+        for record in records:
+            seq = self.extract(record.get_seq())
+            bc, dist = self.decode_hit(seq)
+            stats.add(seq, bc, dist)
+            yield bc or "failed", record
+    
+    def extract(self, fqseq):
+        """Return barcode sequence in given read sequence"""
+        currseq = fqseq[self.startpos:(self.startpos+self.lenbc)]
+        if len(currseq) < self.lenbc:
+            sys.stderr.write("%s not have enough length" % currseq)
+        return currseq
+    
+    def decode_parallel(self, threads):
+        """
+        decode byte ranges of infile in worker processes, 
+        concatenate outputs of ranges in order and return merged stats
+        """
+        chunks = split_fastq(self.infile, threads)
+        if len(chunks) == 1:
+            return self.decode_records(reader_fastq(self.infile), self.outpool)
+        tasks = [(self.outprefix+'.part'+str(i), start, end) 
+            for i, (start, end) in enumerate(chunks)]
+        pool = multiprocessing.Pool(threads, 
+            initializer=_init_worker, initargs=(self,))
+        try:
+            parts = pool.map(_decode_chunk, tasks)
+        finally:
+            pool.close()
+            pool.join()
+        
+        for partprefix, _, _ in tasks:
+            for bc in self.outpool.key2file:
+                partfile = self.outfile(bc, partprefix)
+                self.outpool.append_file(bc, partfile)
+                os.unlink(partfile)
+        
+        stats = DecodeStats()
+        for part in parts:
+            stats.merge(part)
+        return stats
     
     def decode_one(self, seq):
         """
         Return the barcode to the given sequence, 'failed' if no one found
         """
-        bc_decode = "failed"
+        return self.decode_hit(seq)[0] or "failed"
+    
+    def decode_hit(self, seq):
+        """
+        Return (barcode, distance) of the closest barcode within mismatch,
+        barcode is None if ambiguous, and (None, None) if no one found
+        """
         barcode2dist = []
         for bc in self.barcode2name:
             dist = 0
@@ -143,16 +430,34 @@ class Decoder(object):
             barcode2dist.append((bc, dist))
         
         if len(barcode2dist) == 0:
-            return bc_decode
+            return (None, None)
         
         min_dist = min([barcode2dist[i][1] for i in xrange(len(barcode2dist))])
         bc_mindist = [barcode2dist[i][0] for i in xrange(len(barcode2dist)) 
             if barcode2dist[i][1] == min_dist]
         
         if len(bc_mindist) == 1:
-            bc_decode = bc_mindist[0]
+            return (bc_mindist[0], min_dist)
         
-        return bc_decode
+        return (None, min_dist)
+
+################################################################################
+
+_decoder = None
+
+def _init_worker(decoder):
+    """Share decoder and its barcode tables with worker process"""
+    global _decoder
+    _decoder = decoder
+
+def _decode_chunk(task):
+    """Decode one byte range (outprefix, start, end) of infile in worker"""
+    outprefix, start, end = task
+    outpool = _decoder.open_outpool(outprefix)
+    stats = _decoder.decode_records(
+        reader_fastq(_decoder.infile, start, end), outpool)
+    outpool.close()
+    return stats
 
 ################################################################################
 
@@ -160,24 +465,173 @@ class DecoderExact(Decoder):
     """
     Decoding without mismatch
     """ 
-    def decode_one(self, seq):
+    def decode_hit(self, seq):
+        """Return (barcode, 0) of given sequence, (None, None) if no one found"""
+        if seq in self.barcode2name:
+            return (seq, 0)
+        return (None, None)
+    
+################################################################################
+
+class DecoderHash(Decoder):
+    """
+    Decoding by one hash lookup per read:
+    all sequences within mismatch of barcodes are precomputed
+    """
+    def __init__(self, infile, barcode2name, **kwargs):
+        Decoder.__init__(self, infile, barcode2name, **kwargs)
+        self.table = BarcodeTable(self.barcode2name, self.mismatch)
+    
+    def decode_hit(self, seq):
         """
-        Return the barcode to the given sequence, 'failed' if no one found
+        Return (barcode, distance) of the closest barcode within mismatch,
+        barcode is None if ambiguous, and (None, None) if no one found
         """
-        if seq in self.barcode2name:
-            return seq
-        return "failed"
+        return self.table.lookup(seq)
+    
+################################################################################
+
+class DecoderMulti(Decoder):
+    """
+    Decoding combinatorial barcodes of several segments in one pass,
+    e.g. an inline barcode and an index read within read sequence.
+    Barcode is given as its segments joined by '+', e.g. ACGT+GGTACA,
+    each segment is decoded with its own table, and the sample is
+    the combination of decoded segments
+    """
+    def __init__(self, infile, barcode2name, segments, **kwargs):
+        """
+        segments: list of (startpos, length, mismatch), 1-based startpos
+        """
+        assert len(segments) > 0, "No segment"
+        self.segments = [(s - 1, l, m) for (s, l, m) in segments]
+        for (s, l, m) in self.segments:
+            assert s >= 0, "given start position should be 1-based"
+        for bc in barcode2name:
+            segseqs = bc.split('+')
+            assert len(segseqs) == len(self.segments), \
+                "barcode %s not having %d segments" % (bc, len(self.segments))
+            for i, (s, l, m) in enumerate(self.segments):
+                assert len(segseqs[i]) == l, \
+                    "segment %d of barcode %s not in length %d" % (i+1, bc, l)
+        
+        kwargs['mismatch'] = max([m for (s, l, m) in self.segments])
+        kwargs['startpos'] = self.segments[0][0] + 1
+        Decoder.__init__(self, infile, barcode2name, **kwargs)
+        self.tables = [BarcodeTable(set([bc.split('+')[i] 
+                for bc in self.barcode2name]), m) 
+            for i, (s, l, m) in enumerate(self.segments)]
+    
+    def mismatch_tag(self):
+        return '-'.join([str(m) for (s, l, m) in self.segments])
+    
+    def extract(self, fqseq):
+        """Return tuple of segment sequences in given read sequence"""
+        segseqs = tuple([fqseq[s:(s+l)] for (s, l, m) in self.segments])
+        for (s, l, m), segseq in zip(self.segments, segseqs):
+            if len(segseq) < l:
+                sys.stderr.write("%s not have enough length" % segseq)
+        return segseqs
+    
+    def decode_hit(self, segseqs):
+        """
+        Return (barcode, distance) of the given segment sequences, distance
+        summed over segments; barcode is None if any segment is ambiguous, 
+        and (None, None) if any segment is not decoded or the combination 
+        is not a barcode
+        """
+        bcs = []
+        total = 0
+        ambiguous = False
+        for table, segseq in zip(self.tables, segseqs):
+            bc, dist = table.lookup(segseq)
+            if dist is None:
+                return (None, None)
+            if bc is None:
+                ambiguous = True
+            bcs.append(bc)
+            total += dist
+        
+        if ambiguous:
+            return (None, total)
+        bc = '+'.join(bcs)
+        if bc in self.barcode2name:
+            return (bc, total)
+        return (None, None)
     
 ################################################################################
 
-def create_decoder(infile, barcode2name, mismatch=0, startpos=37, outprefix=None):
-    """Factor of decoder"""
+class DecoderNumpy(Decoder):
+    """
+    Decoding batches of reads: barcode sequences of a batch are packed 
+    into a uint8 matrix, and distances to all barcodes are computed at once
+    """
+    def __init__(self, infile, barcode2name, batchsize=4096, **kwargs):
+        Decoder.__init__(self, infile, barcode2name, **kwargs)
+        self.batchsize = batchsize
+        self.barcodes = sorted(self.barcode2name)
+        self.bcarr = np.frombuffer(''.join(self.barcodes), 
+            dtype=np.uint8).reshape(len(self.barcodes), self.lenbc)
+    
+    def iter_decoded(self, records, stats):
+        """Generator of (barcode or 'failed', record) decoded by batch"""
+        for batch in iter_batches(records, self.batchsize):
+            seqs = [self.extract(record.get_seq()) for record in batch]
+            hits = self.decode_batch(seqs)
+            for record, seq, (bc, dist) in zip(batch, seqs, hits):
+                stats.add(seq, bc, dist)
+                yield bc or "failed", record
+    
+    def decode_hit(self, seq):
+        return self.decode_batch([seq])[0]
+    
+    def decode_batch(self, seqs):
+        """Return list of (barcode, distance) as decode_hit for sequences"""
+        lenbc = self.lenbc
+        short = [len(seq) < lenbc for seq in seqs]
+        if any(short):
+            seqs = [seq.ljust(lenbc, '\0') for seq in seqs]
+        arr = np.frombuffer(''.join(seqs), 
+            dtype=np.uint8).reshape(len(seqs), lenbc)
+        dists = (arr[:, None, :] != self.bcarr[None, :, :]).sum(axis=2)
+        min_dist = dists.min(axis=1)
+        found = (min_dist <= self.mismatch) & ~np.array(short, dtype=bool)
+        unique = (dists == min_dist[:, None]).sum(axis=1) == 1
+        idx_min = dists.argmin(axis=1)
+        
+        barcodes = self.barcodes
+        return [((barcodes[i] if u else None), d) if f else (None, None) 
+            for f, u, i, d in zip(found.tolist(), unique.tolist(), 
+                idx_min.tolist(), min_dist.tolist())]
+    
+################################################################################
+
+def create_decoder(infile, barcode2name, mismatch=0, startpos=37, outprefix=None,
+    compress=False, max_open=256, segments=None, method='hash', stages=None,
+    dry_run=False):
+    """
+    Factor of decoder
+    segments: list of (startpos, length, mismatch) for combinatorial barcodes
+    method: decoding with mismatch by 'hash' table, 'numpy' batch or 'scan'
+    stages: list of pipeline stages applied to decoded reads
+    dry_run: no output file is opened, for decode_sample
+    """
+    if segments:
+        return DecoderMulti(infile, barcode2name, segments, 
+            outprefix=outprefix, compress=compress, max_open=max_open,
+            stages=stages, dry_run=dry_run)
+    
     if mismatch == 0:
         dclass = DecoderExact
-    else:
+    elif method == 'numpy':
+        dclass = DecoderNumpy
+    elif method == 'scan':
         dclass = Decoder
+    else:
+        dclass = DecoderHash
         
     return dclass(infile, barcode2name, mismatch=mismatch, startpos=startpos, 
-                  outprefix=outprefix)
+                  outprefix=outprefix, compress=compress, max_open=max_open,
+                  stages=stages, dry_run=dry_run)
 
 ################################################################################
@@ -4,11 +4,20 @@ Expression calculation for 3'-end RNA-seq
 """
 import os
 import sys
+import shutil
+import cPickle
+import hashlib
+import tempfile
+import multiprocessing
+from collections import defaultdict
 from distutils.version import LooseVersion
+import numpy as np
 import pysam
 import HTSeq
 assert LooseVersion(HTSeq.__version__) >= LooseVersion('0.5.3p9') 
 from maps.utils import lazy_property
+from maps.annot import AnnotIndex, StepCursor, merge_regions
+from maps.io_utils.gtf import reader_gtf
 
 ################################################################################
 
@@ -59,9 +68,43 @@ class Counter(object):
     
 ################################################################################
 
+COUNT_MODES = ('strict', 'end3')
+
+SPLIT_METHODS = ('prior', 'em')
+EM_TOL = 0.001
+EM_MAX_ITER = 1000
+
+REGION_BYTES = 1 << 16
+
+FLAG_UNMAPPED = 0x4
+FLAG_SECONDARY = 0x100
+FLAG_SUPPLEMENTARY = 0x800
+
+################################################################################
+
 class DGE(object):
     """DGE"""
-    def __init__(self, tag_file, gtf_file, feature_type, id_feature, id_count):
+    def __init__(self, tag_file, gtf_file, feature_type, id_feature, id_count,
+        cache=False, mode='strict', min_mapq=0, exclude_flags=0, 
+        regions=False, split='prior'):
+        """
+        cache: load annotation from cache built at first use (see cache_dir)
+        mode: 'strict' to assign reads by features of all aligned blocks
+            (intersection-strict), 'end3' by features at the 3'-end base
+        min_mapq: skip reads of lower mapping quality
+        exclude_flags: skip reads having any of these SAM flags (as 
+            samtools view -F, e.g. FLAG_SECONDARY | FLAG_SUPPLEMENTARY), 
+            unmapped reads are always skipped
+        regions: fetch only reads overlapping regions of features from 
+            indexed tag_file, other mapped reads are counted as empty by 
+            index statistics (so no read filters)
+        split: method to split shared reads, 'prior' or 'em' (see 
+            count_shared)
+        """
+        assert not (regions and (min_mapq or exclude_flags)), \
+            'read filters are not applied to reads counted by BAM index'
+        assert mode in COUNT_MODES, 'unknown mode %s' % mode
+        assert split in SPLIT_METHODS, 'unknown split %s' % split
         assert os.path.exists(tag_file), '%s not exists' % tag_file 
         assert os.path.exists(gtf_file), '%s not exists' % gtf_file
         self.tag_file = tag_file
@@ -69,10 +112,19 @@ class DGE(object):
         self.feature_type = feature_type
         self.id_feature = id_feature
         self.id_count = id_count
+        self.cache = cache
+        self.mode = mode
+        self.min_mapq = min_mapq
+        self.exclude_flags = exclude_flags | FLAG_UNMAPPED
+        self.regions = regions
+        self.split = split
         self.numread = 0
         self.nshared = 0
         self.nempty = 0
         self.nunique = 0
+        self.fsets = [] # distinct feature sets of shared reads by id
+        self.fset2id = {} # id in annot to id in fsets
+        self.fsetcounts = None # number of shared reads by feature set id
     
     def __str__(self):
         return "\n".join(["#%s" % self.tag_file, 
@@ -82,12 +134,15 @@ class DGE(object):
                           "#shared: %d" % self.nshared, 
                           "#empty: %d" % self.nempty])
         
-    def count(self, outhandle=sys.stdout):
-        """count and write output"""
-        sys.stderr.write("counting unique ...\n")
-        self.count_unique()
+    def count(self, outhandle=sys.stdout, threads=1):
+        """
+        count and write output
+        threads: number of worker processes counting chromosomes
+        """
+        sys.stderr.write("counting reads ...\n")
+        self.count_unique(threads)
         
-        sys.stderr.write("counting shared ...\n")
+        sys.stderr.write("assigning shared ...\n")
         self.count_shared()
         
         sys.stderr.write("writing result ...\n")
@@ -108,31 +163,84 @@ class DGE(object):
         rpkm = c.rpkm(clen, self.numread)
         return [c.name, c.unique, c.shared, c.num, self.numread, clen, rpkm]
     
+    @lazy_property
+    def annotation(self):
+        """
+        (annot, fid2cid, cid2length), loaded from the cache next to gtf_file
+        if cache is set (see cache_dir), built from gtf_file otherwise and
+        then cached
+        """
+        cachedir = None
+        if self.cache:
+            cachedir = self.cache_dir()
+            if os.path.exists(cachedir):
+                return load_annotation(cachedir)
+        
+        intervals = []
+        chroms = set()
+        fid2cid = {}
+        for chrom, ftype, start, end, strand, (feature_id, count_id) in \
+                reader_gtf(self.gtf_file, (self.id_feature, self.id_count),
+                required=self.feature_type):
+            chroms.add(chrom)
+            if ftype == self.feature_type:
+                intervals.append((chrom, start, end, strand, feature_id))
+                if feature_id not in fid2cid:
+                    fid2cid[feature_id] = count_id
+        annot = AnnotIndex.build(intervals, chroms)
+        
+        cid2length = {}
+        for chrom, strand, start, end, fs in annot.steps():
+            cids = set([fid2cid[f] for f in fs])
+            for cid in cids:
+                if cid not in cid2length:
+                    cid2length[cid] = 0
+                cid2length[cid] += end - start
+        
+        if cachedir:
+            save_annotation(cachedir, annot, fid2cid, cid2length)
+        return annot, fid2cid, cid2length
+    
+    def cache_dir(self):
+        """
+        Return annotation cache directory next to gtf_file, named by 
+        SHA-1 of its content and settings of features and counting units
+        """
+        sha = hashlib.sha1()
+        with open(self.gtf_file, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(1 << 20), ''):
+                sha.update(chunk)
+        sha.update('\0'.join(['', self.feature_type, self.id_feature, 
+            self.id_count, str(CACHE_VERSION)]))
+        return '%s.annot-%s' % (self.gtf_file, sha.hexdigest()[:16])
+    
+    @lazy_property
+    def annot(self):
+        """AnnotIndex: steps of id_feature sets, used to assign reads"""
+        return self.annotation[0]
+    
     @lazy_property
     def gas(self): 
-        """GenomicArrayOfSets: intervals associated id_feature"""
+        """
+        GenomicArrayOfSets: intervals associated id_feature
+        (kept for compatibility, reads are assigned by annot)
+        """
         gas = HTSeq.GenomicArrayOfSets([], stranded=True)
-        for f in HTSeq.GFF_Reader(self.gtf_file):
-            if f.iv.chrom not in gas.chrom_vectors:
-                gas.add_chrom(f.iv.chrom)
-            if f.type == self.feature_type:
-                feature_id = f.attr[self.id_feature]
-                gas[f.iv] += feature_id
+        for chrom, ftype, start, end, strand, (feature_id, ) in \
+                reader_gtf(self.gtf_file, (self.id_feature, ), 
+                required=self.feature_type):
+            if chrom not in gas.chrom_vectors:
+                gas.add_chrom(chrom)
+            if ftype == self.feature_type:
+                gas[HTSeq.GenomicInterval(chrom, start, end, strand)] += \
+                    feature_id
         
         return gas
 
     @lazy_property
     def fid2cid(self):
         """dict of feature_id to count_id"""
-        fid2cid = {}
-        for f in HTSeq.GFF_Reader(self.gtf_file):
-            if f.type == self.feature_type:
-                feature_id = f.attr[self.id_feature]
-                count_id = f.attr[self.id_count]
-                if feature_id not in fid2cid:
-                    fid2cid[feature_id] = count_id
-        
-        return fid2cid
+        return self.annotation[1]
     
     @lazy_property
     def cid2counter(self):
@@ -148,66 +256,300 @@ class DGE(object):
     @lazy_property
     def cid2length(self):
         """dict of count_id to length of merged interval"""
-        cid2length = {}
-        for iv, fs in self.gas.steps():
-            cids = set([self.fid2cid[f] for f in fs])
-            for cid in cids:
-                if cid not in cid2length:
-                    cid2length[cid] = 0
-                cid2length[cid] += iv.length
-        
-        return cid2length
+        return self.annotation[2]
      
-    def iter_reads(self):
-        """Generator of reads as tuple of GenomicInterval object"""
+    def iter_reads(self, chrom=None):
+        """
+        Generator of reads (of given chromosome) as tuple of 
+        GenomicInterval object of aligned blocks (see iter_blocks)
+        """
+        for chrom, strand, blocks in self.iter_blocks(chrom):
+            yield tuple(HTSeq.GenomicInterval(chrom, start, end, strand) 
+                for start, end in blocks)
+    
+    def iter_hits(self, chrom=None):
+        """
+        Generator of (reference names, alignment) of reads 
+        (of given chromosome) passing filters of flags and mapping quality
+        """
         bam = pysam.Samfile(self.tag_file, "rb")
-        for hit in bam.fetch():
-            if hit.is_unmapped:
+        references = bam.references
+        exclude_flags = self.exclude_flags
+        min_mapq = self.min_mapq
+        hits = self.fetch_regions(bam, chrom) if self.regions else \
+            bam.fetch(chrom)
+        for hit in hits:
+            if hit.flag & exclude_flags or hit.mapping_quality < min_mapq:
                 continue
-            
-            chrom = bam.references[hit.rname]
-            strand = '+'
+            yield references, hit
+    
+    def fetch_regions(self, bam, chrom=None):
+        """
+        Generator of alignments of bam (of given chromosome) overlapping 
+        regions of annot, once for a read spanning several regions
+        """
+        chrom2regions = self.chrom2regions
+        for ref in ([chrom] if chrom else bam.references):
+            prev_end = 0
+            for start, end in chrom2regions.get(ref, ()):
+                for hit in bam.fetch(ref, start, end):
+                    # fetched with previous region if overlapping it
+                    if hit.reference_start >= prev_end:
+                        yield hit
+                prev_end = end
+    
+    @lazy_property
+    def chrom2regions(self):
+        """
+        dict of chrom to merged regions of features (see fetch_regions),
+        regions closer than the mean genomic span of REGION_BYTES of reads
+        of the chromosome in tag_file (about reads decompressed by a seek) 
+        are merged, no regions of chromosomes without read
+        """
+        bam = pysam.Samfile(self.tag_file, "rb")
+        chrom2mapped = dict((stats.contig, stats.mapped) 
+            for stats in bam.get_index_statistics())
+        nmapped = sum(chrom2mapped.itervalues())
+        size = os.path.getsize(self.tag_file)
+        chrom2regions = {}
+        for chrom, ivals in self.annot.regions().iteritems():
+            if chrom not in bam.references or not chrom2mapped.get(chrom):
+                continue
+            gap = (bam.get_reference_length(chrom) * REGION_BYTES * nmapped //
+                (size * chrom2mapped[chrom]))
+            chrom2regions[chrom] = merge_regions(ivals, gap)
+        return chrom2regions
+    
+    def count_mapped(self, chrom=None):
+        """Return number of mapped reads (of given chromosome) by BAM index"""
+        bam = pysam.Samfile(self.tag_file, "rb")
+        return sum(stats.mapped for stats in bam.get_index_statistics()
+            if chrom is None or stats.contig == chrom)
+    
+    def iter_blocks(self, chrom=None):
+        """
+        Generator of reads (of given chromosome) as (chrom, strand, blocks),
+        blocks: list of (start, end) of aligned blocks by pysam, 
+        split at deletions and skipped regions (CIGAR M/=/X are aligned,
+        I/S/H/P take no reference position)
+        """
+        for references, hit in self.iter_hits(chrom):
+            yield (references[hit.reference_id], 
+                '-' if hit.is_reverse else '+', hit.get_blocks())
+    
+    def iter_ends(self, chrom=None):
+        """
+        Generator of reads (of given chromosome) as (chrom, strand, position)
+        of the 3'-most aligned base of the read on its strand
+        """
+        for references, hit in self.iter_hits(chrom):
             if hit.is_reverse:
-                strand = '-'
-
-            iv_list = []
-            start = hit.positions[0]
-            for ctype, clen in hit.cigar: # support only match or skipped region
-                if ctype == 0:
-                    iv_list.append(HTSeq.GenomicInterval(chrom, start, start+clen, strand))
-                elif ctype == 3:
-                    pass
-                else:
-                    sys.exit("unknown CIGAR type: %d, now only support[0|3]" % ctype)
-                start += clen
-                                
-            yield tuple(iv_list)
-    
-    def count_unique(self):
-        """Count reads that is uniquely assignable"""
-        for read in self.iter_reads():
-            self.numread += 1
-            fs = self.read2features(read)
+                yield references[hit.reference_id], '-', hit.reference_start
+            else:
+                yield references[hit.reference_id], '+', hit.reference_end - 1
+    
+    def count_unique(self, threads=1):
+        """
+        Count reads that is uniquely assignable, in the same pass
+        count shared reads by their feature set (see count_shared)
+        threads: number of worker processes counting chromosomes
+        """
+        if threads > 1:
+            self.add_tally(self.tally_parallel(threads))
+        else:
+            self.add_tally(self.tally())
+    
+    def add_tally(self, fsid2count):
+        """Add reads tallied by feature set id (see tally) to counters"""
+        fset2id = self.fset2id
+        fsetcounts = self.fsetcounts = self.fsetcounts or []
+        annot_fsets = self.annot.fsets
+        for annot_id in sorted(fsid2count):
+            num = fsid2count[annot_id]
+            self.numread += num
+            fs = annot_fsets[annot_id]
             if len(fs) > 1: 
-                self.nshared += 1
+                self.nshared += num
+                fsid = fset2id.get(annot_id)
+                if fsid is None:
+                    fsid = fset2id[annot_id] = len(self.fsets)
+                    self.fsets.append(tuple(fs))
+                    fsetcounts.append(0)
+                fsetcounts[fsid] += num
             elif len(fs) == 0:
-                self.nempty += 1
+                self.nempty += num
             else: 
-                self.nunique += 1
-                cid = self.fid2cid[fs[0]]
+                self.nunique += num
+                cid = self.fid2cid[next(iter(fs))]
                 cnter = self.cid2counter[cid]
-                cnter.unique += 1
+                cnter.unique += num
+    
+    def tally(self, chrom=None):
+        """
+        Return dict of feature set id in annot to number of reads 
+        (of given chromosome), id 0 for reads without feature,
+        ids are local to the process (see AnnotIndex.to_sets)
+        """
+        if self.mode == 'end3':
+            fsid2count = self.tally_ends(chrom)
+        else:
+            fsid2count = self.tally_sweep(chrom)
+        if self.regions: # reads not fetched have no feature
+            nrest = self.count_mapped(chrom) - sum(fsid2count.itervalues())
+            if nrest:
+                fsid2count[0] = fsid2count.get(0, 0) + nrest
+        return fsid2count
+    
+    def tally_sweep(self, chrom=None):
+        """
+        Tally reads (of given chromosome) in intersection-strict mode, 
+        sweeping reads in coordinate order along steps of annot, 
+        with a cursor per strand of the current chromosome
+        """
+        annot = self.annot
+        fsid2count = defaultdict(int)
+        current = None
+        for ref, strand, blocks in self.iter_blocks(chrom):
+            if ref != current:
+                current = ref
+                cursors = {}
+            if not blocks or ref not in annot.chroms:
+                fsid2count[0] += 1
+                continue
+            cursor = cursors.get(strand)
+            if cursor is None:
+                cursor = cursors[strand] = StepCursor(annot, ref, strand)
+            fsid2count[cursor.lookup_blocks(blocks)] += 1
+        return dict(fsid2count)
+    
+    def tally_ends(self, chrom=None, batchsize=1<<20):
+        """
+        Tally reads (of given chromosome) by features at their 3'-end,
+        positions are looked up in batches of arrays per chromosome/strand
+        """
+        fsid2count = defaultdict(int)
+        key2pos = defaultdict(list)
+        npos = 0
+        for ref, strand, pos in self.iter_ends(chrom):
+            key2pos[(ref, strand)].append(pos)
+            npos += 1
+            if npos == batchsize:
+                self._tally_points(key2pos, fsid2count)
+                key2pos.clear()
+                npos = 0
+        self._tally_points(key2pos, fsid2count)
+        return dict(fsid2count)
+    
+    def _tally_points(self, key2pos, fsid2count):
+        """Add counts of feature set ids of positions by (chrom, strand)"""
+        for (chrom, strand), positions in key2pos.iteritems():
+            fsids = self.annot.lookup_points(chrom, strand, positions)
+            for fsid, num in zip(*np.unique(fsids, return_counts=True)):
+                fsid2count[int(fsid)] += int(num)
+    
+    def tally_parallel(self, threads):
+        """
+        Tally reads of chromosomes in worker processes sharing annot,
+        by BAM index, return merged tallies, passed from workers by 
+        feature sets (ids of sets interned in a worker are its own)
+        """
+        self.annot # build before fork
+        if self.regions:
+            self.chrom2regions
+        bam = pysam.Samfile(self.tag_file, "rb")
+        chroms = [chrom for length, chrom in 
+            sorted(zip(bam.lengths, bam.references), reverse=True)]
+        bam.close()
+        pool = multiprocessing.Pool(threads, 
+            initializer=_init_worker, initargs=(self,))
+        try:
+            tallies = pool.map(_tally_chrom, chroms, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        
+        fsid2count = defaultdict(int)
+        for part in tallies:
+            for fsid, num in self.annot.from_sets(part).iteritems():
+                fsid2count[fsid] += num
+        return dict(fsid2count)
     
     def count_shared(self):
-        """Assign ambiguous/shared reads to counter unit"""
-        for read in self.iter_reads():
-            fs = self.read2features(read)
-            if len(fs) > 1:
-                cnters = [self.cid2counter[self.fid2cid[f]] for f in fs]
-                uniqcnts = [ct.unique + 1 for ct in cnters] # with prior 1
-                uniqsum = float(sum(uniqcnts))
-                for i in range(len(cnters)):
-                    cnters[i].shared += uniqcnts[i] / uniqsum
+        """
+        Assign ambiguous/shared reads to counter unit,
+        reads of a feature set together, from counts of count_unique,
+        by split method of DGE (see split_prior, split_em)
+        """
+        if self.fsetcounts is None:
+            self.count_unique()
+        if self.split == 'em':
+            self.split_em()
+        else:
+            self.split_prior()
+    
+    def split_prior(self):
+        """
+        Split reads of each feature set in one step, in proportion to 
+        unique reads of counter units with prior 1
+        """
+        for fs, num in zip(self.fsets, self.fsetcounts):
+            cnters = [self.cid2counter[self.fid2cid[f]] for f in fs]
+            uniqcnts = [ct.unique + 1 for ct in cnters] # with prior 1
+            uniqsum = float(sum(uniqcnts))
+            for i in range(len(cnters)):
+                cnters[i].shared += num * uniqcnts[i] / uniqsum
+    
+    def class_table(self):
+        """
+        Return equivalence classes of shared reads as arrays 
+        (cids, unique, entry_class, entry_cid, counts): counter units 
+        sharing reads and their unique reads, class and unit index of 
+        each feature of a class, number of reads of each class
+        """
+        cids = []
+        cid2idx = {}
+        entry_class = []
+        entry_cid = []
+        for k, fs in enumerate(self.fsets):
+            for f in fs:
+                cid = self.fid2cid[f]
+                if cid not in cid2idx:
+                    cid2idx[cid] = len(cids)
+                    cids.append(cid)
+                entry_class.append(k)
+                entry_cid.append(cid2idx[cid])
+        unique = np.array([self.cid2counter[cid].unique for cid in cids], 
+            dtype=np.float64)
+        return (cids, unique, np.array(entry_class, dtype=np.int64), 
+            np.array(entry_cid, dtype=np.int64),
+            np.array(self.fsetcounts, dtype=np.float64))
+    
+    def split_em(self, tol=EM_TOL, max_iter=EM_MAX_ITER):
+        """
+        Split reads of feature sets by EM over the equivalence class table:
+        reads of a class in proportion to abundance of its counter units,
+        estimated as unique + shared reads with prior 1 (the first 
+        iteration is split_prior), until shared reads of no unit change 
+        more than tol
+        Return number of iterations
+        """
+        cids, unique, entry_class, entry_cid, counts = self.class_table()
+        nclass = len(counts)
+        shared = np.zeros(len(cids))
+        niter = 0
+        while niter < max_iter:
+            niter += 1
+            weight = (unique + shared + 1)[entry_cid]
+            total = np.bincount(entry_class, weight, nclass)
+            resp = counts[entry_class] * weight / total[entry_class]
+            updated = np.bincount(entry_cid, resp, len(cids))
+            delta = np.abs(updated - shared).max() if len(cids) else 0
+            shared = updated
+            if delta <= tol:
+                break
+        for cid, num in zip(cids, shared):
+            self.cid2counter[cid].shared += num
+        return niter
     
     def read2features(self, iv_tuple):
         """
@@ -215,20 +557,142 @@ class DGE(object):
         iv_tuple: representation of mapped read as tuple of GenomicInterval
         intersection-strict mode
         """
-        fs = None
-        for iv in iv_tuple:
-            if iv.chrom not in self.gas.chrom_vectors:
-                continue
-            for step in self.gas[iv].steps():
-                fs2 = step[1]
-                if fs is None:
-                    fs = fs2.copy()
-                else:
-                    fs = fs.intersection(fs2)
-        
-        if fs is None: 
+        fsid = self.read2fsid(iv_tuple)
+        if fsid is None: 
             return []
         else:
-            return list(fs)
+            return list(self.annot.fsets[fsid])
+    
+    def read2fsid(self, iv_tuple):
+        """
+        Return id of feature set in annot assignable to given read,
+        None if no block on annotated chromosomes
+        """
+        return self.annot.lookup_blocks((iv.chrom, iv.strand, iv.start, iv.end)
+            for iv in iv_tuple)
         
-################################################################################
\ No newline at end of file
+################################################################################
+
+CACHE_VERSION = 1
+
+def save_annotation(cachedir, annot, fid2cid, cid2length):
+    """
+    Save annotation to cache directory, by renaming a temporary directory
+    so that concurrent jobs see a complete cache or none
+    """
+    try:
+        tmpdir = tempfile.mkdtemp(prefix=os.path.basename(cachedir) + '.', 
+            dir=os.path.dirname(os.path.abspath(cachedir)))
+    except OSError, err:
+        sys.stderr.write("annotation not cached: %s\n" % err)
+        return
+    annot.save(tmpdir)
+    with open(os.path.join(tmpdir, 'dge.pkl'), 'wb') as oh:
+        cPickle.dump((fid2cid, cid2length), oh, cPickle.HIGHEST_PROTOCOL)
+    try:
+        os.rename(tmpdir, cachedir)
+    except OSError: # cached by another job
+        shutil.rmtree(tmpdir)
+
+def load_annotation(cachedir):
+    """Return (annot, fid2cid, cid2length) loaded from cache directory"""
+    annot = AnnotIndex.load(cachedir)
+    with open(os.path.join(cachedir, 'dge.pkl'), 'rb') as fh:
+        fid2cid, cid2length = cPickle.load(fh)
+    return annot, fid2cid, cid2length
+
+################################################################################
+
+class DGEMatrix(object):
+    """
+    DGE of several read files with the same annotation, 
+    built once and shared, written as matrices of counting units x samples
+    """
+    def __init__(self, tag_files, gtf_file, feature_type, id_feature, id_count,
+        names=None, **options):
+        """
+        names: unique sample names (matrix columns), base names of tag_files
+            by default, paths if base names collide
+        options: options of DGE (cache, mode, min_mapq, exclude_flags, 
+            regions, split)
+        """
+        self.dges = [DGE(f, gtf_file, feature_type, id_feature, id_count, 
+            **options) for f in tag_files]
+        if not names:
+            names = [os.path.basename(f).rsplit('.bam', 1)[0] 
+                for f in tag_files]
+            if len(set(names)) < len(names):
+                names = [f.rsplit('.bam', 1)[0] for f in tag_files]
+        self.names = names
+        assert len(self.names) == len(self.dges), "one name per sample"
+        assert len(set(self.names)) == len(self.names), \
+            "duplicate sample names %s" % ', '.join(self.names)
+        first = self.dges[0]
+        for dge in self.dges[1:]:
+            dge.annot = first.annot
+            dge.fid2cid = first.fid2cid
+            dge.cid2length = first.cid2length
+    
+    def count(self, threads=1):
+        """Count read files in worker processes sharing annotation"""
+        first = self.dges[0]
+        first.annot, first.fid2cid, first.cid2length # build before fork
+        if threads > 1:
+            pool = multiprocessing.Pool(threads, 
+                initializer=_init_worker, initargs=(self,))
+            try:
+                tallies = pool.map(_tally_sample, range(len(self.dges)), 
+                    chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+            # by feature sets, ids of sets interned in a worker are its own
+            tallies = [first.annot.from_sets(part) for part in tallies]
+        else:
+            tallies = [dge.tally() for dge in self.dges]
+        for dge, fsid2count in zip(self.dges, tallies):
+            dge.add_tally(fsid2count)
+            dge.count_shared()
+    
+    def write(self, outprefix):
+        """
+        Write matrices of unique, shared reads and RPKM to 
+        outprefix.unique, outprefix.shared, outprefix.rpkm
+        """
+        first = self.dges[0]
+        cids = sorted(first.cid2counter)
+        for kind in ('unique', 'shared', 'rpkm'):
+            with open('%s.%s' % (outprefix, kind), 'w') as oh:
+                oh.write("#%s\n" % first.gtf_file)
+                oh.write("\t".join(["#read", ""] + 
+                    [str(dge.numread) for dge in self.dges]) + "\n")
+                oh.write("\t".join(["id", "length"] + self.names) + "\n")
+                for cid in cids:
+                    clen = first.cid2length[cid]
+                    fields = [cid, str(clen)]
+                    for dge in self.dges:
+                        c = dge.cid2counter[cid]
+                        if kind == 'unique':
+                            fields.append(str(c.unique))
+                        elif kind == 'shared':
+                            fields.append("%.4f" % c.shared)
+                        else:
+                            fields.append("%.4f" % c.rpkm(clen, dge.numread))
+                    oh.write("\t".join(fields) + "\n")
+
+################################################################################
+
+_dge = None # DGE or DGEMatrix shared by worker processes
+
+def _init_worker(dge):
+    global _dge
+    _dge = dge
+
+def _tally_chrom(chrom):
+    return _dge.annot.to_sets(_dge.tally(chrom))
+
+def _tally_sample(i):
+    dge = _dge.dges[i]
+    return dge.annot.to_sets(dge.tally())
+
+################################################################################
@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+"""
+Gzip/BGZF compressed files
+Reading decompresses in a background thread, writing compresses BGZF blocks
+in a thread pool, so (de)compression overlaps with parsing
+"""
+
+import os
+import zlib
+import struct
+import threading
+import Queue
+import multiprocessing
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+################################################################################
+
+BGZF_BLOCK_SIZE = 0xff00 # max uncompressed bytes per block, as samtools
+BGZF_EOF = ("\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43"
+            "\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00")
+READ_SIZE = 1 << 20
+
+################################################################################
+
+def is_gzip(filename):
+    """Whether given file is gzip (or BGZF) compressed"""
+    with open(filename, 'rb') as fh:
+        return fh.read(2) == "\x1f\x8b"
+
+def is_bgzf(filename):
+    """Whether given file is BGZF compressed (gzip with BC extra field)"""
+    with open(filename, 'rb') as fh:
+        header = fh.read(18)
+    return (len(header) == 18 and header[:4] == "\x1f\x8b\x08\x04" and 
+        header[12:14] == "BC")
+
+################################################################################
+
+def compress_block(data, level=6):
+    """Return one BGZF block of given data (<= BGZF_BLOCK_SIZE bytes)"""
+    cobj = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    cdata = cobj.compress(data) + cobj.flush()
+    header = struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6,
+        66, 67, 2, len(cdata) + 25)
+    footer = struct.pack('<2I', zlib.crc32(data) & 0xffffffff, len(data))
+    return header + cdata + footer
+
+################################################################################
+
+_pool = None
+_pool_pid = None
+
+def get_pool():
+    """Return thread pool shared by writers of current process"""
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        _pool = ThreadPool(max(2, multiprocessing.cpu_count()))
+        _pool_pid = os.getpid()
+    return _pool
+
+################################################################################
+
+class BgzfWriter(object):
+    """
+    File-like writer of BGZF blocks compressed in a thread pool
+    Output can be read by gzip, zcat and htslib
+    """
+    def __init__(self, filename, mode='w', level=6, pool=None):
+        assert mode in ('w', 'a'), "mode should be 'w' or 'a'"
+        self.filename = filename
+        self.level = level
+        self.pool = pool or get_pool()
+        self.fh = open(filename, mode + 'b')
+        self._buf = []
+        self._bufsize = 0
+        self._pending = deque()
+        self._maxpending = 4 * max(2, multiprocessing.cpu_count())
+
+    def write(self, data):
+        """Buffer data, submit full blocks to thread pool"""
+        self._buf.append(data)
+        self._bufsize += len(data)
+        if self._bufsize >= BGZF_BLOCK_SIZE:
+            self._submit(final=False)
+
+    def _submit(self, final):
+        """Submit buffered data as blocks, keep remainder unless final"""
+        data = ''.join(self._buf)
+        nfull = len(data) // BGZF_BLOCK_SIZE
+        if final and len(data) % BGZF_BLOCK_SIZE:
+            nfull += 1
+        for i in xrange(nfull):
+            block = data[i*BGZF_BLOCK_SIZE:(i+1)*BGZF_BLOCK_SIZE]
+            self._pending.append(
+                self.pool.apply_async(compress_block, (block, self.level)))
+        rest = data[nfull*BGZF_BLOCK_SIZE:]
+        self._buf = [rest] if rest else []
+        self._bufsize = len(rest)
+        while len(self._pending) > self._maxpending:
+            self.fh.write(self._pending.popleft().get())
+
+    def flush(self):
+        """Compress and write all buffered data"""
+        self._submit(final=True)
+        while self._pending:
+            self.fh.write(self._pending.popleft().get())
+        self.fh.flush()
+
+    def write_raw(self, data):
+        """Write already compressed data after all buffered data"""
+        self.flush()
+        self.fh.write(data)
+
+    def close(self, eof=True):
+        """Flush and close, add BGZF EOF marker if eof"""
+        if self.fh.closed:
+            return
+        self.flush()
+        if eof:
+            self.fh.write(BGZF_EOF)
+        self.fh.close()
+
+    @property
+    def closed(self):
+        return self.fh.closed
+
+################################################################################
+
+def copy_compressed(infile, writer):
+    """
+    Append compressed content of gzip/BGZF file to BgzfWriter
+    without recompression, skipping its trailing BGZF EOF marker
+    """
+    size = os.path.getsize(infile)
+    with open(infile, 'rb') as fh:
+        if size >= len(BGZF_EOF):
+            fh.seek(size - len(BGZF_EOF))
+            if fh.read() == BGZF_EOF:
+                size -= len(BGZF_EOF)
+            fh.seek(0)
+        while size > 0:
+            data = fh.read(min(READ_SIZE, size))
+            if not data:
+                break
+            size -= len(data)
+            writer.write_raw(data)
+
+################################################################################
+
+class GzipReader(object):
+    """
+    Line iterator of gzip/BGZF file (multiple members supported),
+    decompressed in a background thread
+    """
+    def __init__(self, filename, maxchunk=16):
+        self.filename = filename
+        self._queue = Queue.Queue(maxchunk)
+        self._stop = threading.Event()
+        self._error = None
+        self._thread = threading.Thread(target=self._decompress)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _put(self, chunk):
+        """Put chunk to queue unless reader is closed"""
+        while not self._stop.is_set():
+            try:
+                self._queue.put(chunk, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _decompress(self):
+        """Read and decompress members, put decompressed chunks to queue"""
+        try:
+            with open(self.filename, 'rb') as fh:
+                dobj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                while True:
+                    raw = fh.read(READ_SIZE)
+                    if not raw:
+                        break
+                    while raw:
+                        chunk = dobj.decompress(raw)
+                        raw = dobj.unused_data
+                        if raw: # next member
+                            dobj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                        if chunk and not self._put(chunk):
+                            return
+        except Exception, err:
+            self._error = err
+        self._put(None)
+
+    def chunks(self):
+        """Generator of decompressed chunks"""
+        while True:
+            chunk = self._queue.get()
+            if chunk is None:
+                break
+            yield chunk
+        if self._error is not None:
+            raise IOError("%s: %s" % (self.filename, self._error))
+
+    def __iter__(self):
+        rest = ''
+        for chunk in self.chunks():
+            lines = (rest + chunk).split('\n')
+            rest = lines.pop()
+            for line in lines:
+                yield line + '\n'
+        if rest:
+            yield rest
+
+    def close(self):
+        self._stop.set()
+
+def read_block(fh):
+    """
+    Read BGZF block at current position of file handle
+    Return (block size in file, uncompressed data), None at end of file
+    """
+    header = fh.read(12)
+    if not header:
+        return None
+    if len(header) < 12 or header[:4] != "\x1f\x8b\x08\x04":
+        raise IOError("Invalid BGZF block at %d" % (fh.tell() - len(header)))
+    xlen = struct.unpack('<H', header[10:12])[0]
+    extra = fh.read(xlen)
+    bsize = None
+    i = 0
+    while i + 4 <= xlen:
+        slen = struct.unpack('<H', extra[i+2:i+4])[0]
+        if extra[i:i+2] == "BC":
+            bsize = struct.unpack('<H', extra[i+4:i+6])[0]
+        i += 4 + slen
+    if bsize is None:
+        raise IOError("Invalid BGZF block, no BC field")
+    cdata = fh.read(bsize - xlen - 19)
+    footer = fh.read(8)
+    data = zlib.decompress(cdata, -zlib.MAX_WBITS)
+    if len(data) != struct.unpack('<I', footer[4:])[0]:
+        raise IOError("Truncated BGZF block")
+    return bsize + 1, data
+
+def iter_bgzf_blocks(filename, coffset=0):
+    """Generator of (offset in file, uncompressed data) of BGZF blocks"""
+    with open(filename, 'rb') as fh:
+        fh.seek(coffset)
+        while True:
+            block = read_block(fh)
+            if block is None:
+                break
+            yield coffset, block[1]
+            coffset += block[0]
+
+def iter_bgzf_range(filename, start=0, end=None):
+    """
+    Generator of uncompressed data of BGZF file in [start, end) 
+    of virtual offsets (offset of block << 16 | offset in block)
+    """
+    for coffset, data in iter_bgzf_blocks(filename, start >> 16):
+        lo = 0
+        hi = len(data)
+        if coffset == start >> 16:
+            lo = start & 0xffff
+        if end is not None:
+            if coffset > end >> 16:
+                break
+            if coffset == end >> 16:
+                hi = end & 0xffff
+        if hi > lo:
+            yield data[lo:hi] if lo or hi < len(data) else data
+
+################################################################################
+
+def open_file(filename, mode='r'):
+    """
+    Open file for reading (gzip/BGZF detected from content)
+    or writing (BGZF if name ends with .gz)
+    """
+    if mode == 'r':
+        if is_gzip(filename):
+            return GzipReader(filename)
+        return open(filename)
+    elif filename.endswith('.gz'):
+        return BgzfWriter(filename, mode)
+    return open(filename, mode)
+
+################################################################################
@@ -3,21 +3,42 @@
 Fastq format
 """
 
+import os
+import sys
+import random
+import numpy as np
+from itertools import islice, groupby, imap
+from maps.utils import iter_batches, map_ordered
+from maps.io_utils.bgzf import (open_file, is_gzip, is_bgzf, GzipReader, 
+    iter_bgzf_blocks, iter_bgzf_range)
+
 ################################################################################
 
 class Fastq(object):
     """
     Fastq record
+    A parsed record keeps its original '+' line, so that its original text 
+    is written unchanged (see as_raw), or with that '+' line if trimmed
     """
-    def __init__(self, name, seq, qual):
+    __slots__ = ('name', 'seq', 'qual', '_plus')
+    
+    def __init__(self, name, seq, qual, plus=None):
         self.name = name
         self.seq = seq
         self.qual = qual
+        self._plus = plus
     
     def __str__(self):
         return '\n'.join(['@%s' % str(self.name), self.seq, 
             '+%s' % self.name, self.qual])
     
+    def as_raw(self):
+        """Return text of record with newline, with original '+' line if any"""
+        if self._plus is None:
+            return str(self) + '\n'
+        return '@%s\n%s\n%s\n%s\n' % (self.name, self.seq, self._plus, 
+            self.qual)
+    
     def as_simple(self):
         return '\n'.join(['@%s' % str(self.name), self.seq, '+', self.qual])
     
@@ -26,6 +47,7 @@ class Fastq(object):
     
     def clean_name(self):
         self.name = self.name.split(" ")[0]
+        self._plus = None
     
     def get_seq(self):
         return self.seq
@@ -47,78 +69,547 @@ class Fastq(object):
     def set_name(self, name):
         """Reset name"""
         self.name = name
+        self._plus = None
+
+    def trim(self, start=0, end=None):
+        """Keep sequence and quality in [start, end)"""
+        self.seq = self.seq[start:end]
+        self.qual = self.qual[start:end]
 
     def remove_tail_N(self):
         """Remove N at the end"""
-        i = len(self.seq) - 1
-        while i >= 0:
-            if self.seq[i] == 'N':
-                i -= 1
-            else:
-                break
-        self.seq = self.seq[:i+1]
-        self.qual = self.qual[:i+1]
+        end = len(self.seq.rstrip('N'))
+        if end < len(self.seq):
+            self.trim(0, end)
 
 ################################################################################
     
-def reader_fastq(infile):
-    """Generator of Fastq object from given file"""
-    i = 0
-    name = None
-    seq = None
-    qual = None
-    for line in open(infile):
-        i += 1
-        curr_line = line.strip()
-        if i % 4 == 1:
-            name = curr_line[1:]
-        elif i % 4 == 2:
-            seq = curr_line
-        elif i % 4 == 0:
-            qual = curr_line
-            yield Fastq(name, seq, qual)
-            
+BLOCK_SIZE = 1 << 22
+
+def reader_fastq(infile, start=0, end=None):
+    """
+    Generator of Fastq object from given file
+    start, end: byte range of records, at record boundaries (see split_fastq),
+    virtual offsets for BGZF file (see FastqIndex)
+    gzip file is read as a whole
+    """
+    for fq in parse_fastq_blocks(iter_file_chunks(infile, start, end)):
+        yield fq
+
+def iter_file_chunks(infile, start=0, end=None):
+    """
+    Generator of text chunks of file in byte range (see reader_fastq),
+    decompressed if gzip
+    """
+    if is_gzip(infile):
+        if start or end is not None:
+            assert is_bgzf(infile), \
+                "byte range not supported for gzip %s" % infile
+            for chunk in iter_bgzf_range(infile, start, end):
+                yield chunk
+            return
+        fh = GzipReader(infile)
+        chunks = fh.chunks()
+    else:
+        fh = open(infile, 'rb')
+        if start:
+            fh.seek(start)
+        chunks = iter_chunks(fh, None if end is None else end - start)
+    
+    try:
+        for chunk in chunks:
+            yield chunk
+    finally: # also if stopped early, to end decompressing thread of gzip
+        fh.close()
+
+def iter_chunks(fh, size=None):
+    """Generator of blocks of file, at most size bytes in total if given"""
+    while size is None or size > 0:
+        chunk = fh.read(BLOCK_SIZE if size is None else min(BLOCK_SIZE, size))
+        if not chunk:
+            break
+        if size is not None:
+            size -= len(chunk)
+        yield chunk
+
+################################################################################
+
+def parse_fastq_blocks(chunks):
+    """
+    Generator of Fastq object from text chunks of a file
+    Each block is split into lines at once, whole records are taken from them,
+    the remaining lines are carried to next block
+    """
+    rest = ''
+    for chunk in chunks:
+        block = rest + chunk
+        lines = block.split('\n')
+        nline = (len(lines) - 1) // 4 * 4
+        rest = '\n'.join(lines[nline:])
+        if '\r' in block:
+            lines = [line.rstrip('\r') for line in lines[:nline]]
+        for i in xrange(0, nline, 4):
+            name = lines[i]
+            if name[:1] != '@':
+                raise ValueError("Fastq record not starting with @: %s" % name)
+            yield Fastq(name[1:], lines[i+1], lines[i+3], lines[i+2])
+    
+    # last record without newline at end of file
+    lines = [line.rstrip('\r') for line in rest.rstrip('\r\n').split('\n')]
+    if len(lines) == 4:
+        if lines[0][:1] != '@':
+            raise ValueError("Fastq record not starting with @: %s" % lines[0])
+        yield Fastq(lines[0][1:], lines[1], lines[3], lines[2])
+
+################################################################################
+
+def sync_fastq(fh, offset):
+    """
+    Return the offset of first record starting at or after given offset:
+    a line starting with '@' followed by sequence and a line starting with '+'
+    """
+    if offset <= 0:
+        return 0
+    fh.seek(offset - 1)
+    pos = offset - 1 + len(fh.readline())
+    lines = []
+    while True:
+        line = fh.readline()
+        if not line:
+            break
+        lines.append((pos, line))
+        pos += len(line)
+        if len(lines) == 3:
+            if lines[0][1].startswith('@') and lines[2][1].startswith('+'):
+                return lines[0][0]
+            lines.pop(0)
+    
+    return pos
+
+################################################################################
+
+class FastqIndex(object):
+    """
+    Offsets of every step-th record of Fastq file (.fqi index),
+    virtual offsets (offset of block << 16 | offset in block) for BGZF file.
+    Index file is text, a header line and one offset per line:
+    ##fqi step=1000 records=N size=<size of Fastq file> bgzf=0
+    """
+    def __init__(self, offsets, step, nrecord, size, bgzf=False):
+        self.offsets = offsets
+        self.step = step
+        self.nrecord = nrecord
+        self.size = size
+        self.bgzf = bgzf
+    
+    @classmethod
+    def build(cls, infile, step=1000):
+        """
+        Index given Fastq file (uncompressed or BGZF),
+        newlines of each block are located by NumPy
+        """
+        bgzf = is_gzip(infile)
+        if bgzf:
+            assert is_bgzf(infile), "index not supported for gzip %s" % infile
+            blocks = ((coffset << 16, data) for coffset, data in 
+                iter_bgzf_blocks(infile))
+        else:
+            fh = open(infile, 'rb')
+            blocks = iter_file_blocks(fh)
+        
+        offsets = []
+        nline = 0 # lines before current block
+        target = 0 # line number of next indexed record
+        last = '\n' # last byte of file
+        for base, data in blocks:
+            if data:
+                last = data[-1:]
+            newlines = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == 10)
+            count = len(newlines)
+            while target <= nline + count:
+                if target == nline:
+                    pos = 0
+                else:
+                    pos = int(newlines[target - nline - 1]) + 1
+                    if pos == len(data):
+                        break # record starts at next block
+                offsets.append(base + pos)
+                target += 4 * step
+            nline += count
+        if not bgzf:
+            fh.close()
+        
+        if last != '\n': # last line without newline
+            nline += 1
+        nrecord = nline // 4
+        offsets = [o for i, o in enumerate(offsets) if i * step < nrecord]
+        return cls(offsets, step, nrecord, os.path.getsize(infile), bgzf)
+    
+    @classmethod
+    def load(cls, indexfile):
+        with open(indexfile) as fh:
+            header = fh.readline().split()
+            assert header[0] == '##fqi', "not fqi index %s" % indexfile
+            fields = dict(item.split('=') for item in header[1:])
+            offsets = [int(line) for line in fh]
+        return cls(offsets, int(fields['step']), int(fields['records']), 
+            int(fields['size']), fields['bgzf'] == '1')
+    
+    def save(self, indexfile):
+        with open(indexfile, 'w') as oh:
+            oh.write("##fqi step=%d records=%d size=%d bgzf=%d\n" % (
+                self.step, self.nrecord, self.size, self.bgzf))
+            for offset in self.offsets:
+                oh.write("%d\n" % offset)
+    
+    def is_valid(self, infile):
+        """Whether index matches size of given file"""
+        return os.path.getsize(infile) == self.size
+    
+    def seek_offset(self, record):
+        """Return (offset of closest indexed record, records to skip)"""
+        i = record // self.step
+        return self.offsets[i], record - i * self.step
+    
+    def split(self, nchunk):
+        """
+        Split indexed file into at most nchunk ranges [start, end) 
+        of (virtual) offsets at indexed records, end of last range is None
+        """
+        if not self.offsets: # empty file
+            return [(0, None)]
+        noffset = len(self.offsets)
+        idx = sorted(set(noffset * i // nchunk for i in xrange(nchunk)))
+        starts = [self.offsets[i] for i in idx]
+        return zip(starts, starts[1:] + [None])
+
+def iter_file_blocks(fh):
+    """Generator of (file offset, block) of file handle"""
+    offset = fh.tell()
+    for chunk in iter_chunks(fh):
+        yield offset, chunk
+        offset += len(chunk)
+
+def index_fastq(infile, step=1000, indexfile=None):
+    """Build, save (to infile.fqi by default) and return FastqIndex"""
+    index = FastqIndex.build(infile, step)
+    index.save(indexfile or infile + '.fqi')
+    return index
+
+def load_index(infile, indexfile=None):
+    """Return FastqIndex of given file, None if not found or outdated"""
+    indexfile = indexfile or infile + '.fqi'
+    if not os.path.exists(indexfile):
+        return None
+    index = FastqIndex.load(indexfile)
+    if not index.is_valid(infile):
+        return None
+    return index
+
+def reader_fastq_records(infile, start=0, end=None, index=None):
+    """
+    Generator of Fastq object of records [start, end) (0-based record number)
+    of given file, seeking by index (loaded from infile.fqi if not given)
+    """
+    index = index or load_index(infile)
+    if index is None:
+        offset, skip = 0, start
+    elif start >= index.nrecord: # as unindexed, no record past end
+        return
+    else:
+        offset, skip = index.seek_offset(start)
+    records = reader_fastq(infile, offset)
+    stop = None if end is None else skip + end - start
+    for fq in islice(records, skip, stop):
+        yield fq
+
+################################################################################
+
+def sample_fastq(infile, fraction=None, count=None, seed=0):
+    """
+    Return iterator of randomly sampled Fastq records of given file, 
+    a fraction or a fixed count of records, reproducible by seed
+    Indexed (.fqi) file: records are chosen by number and read by seeking;
+    uncompressed file: records at random offsets are read by seeking, 
+    records after longer ones are slightly favored;
+    gzip file: records are kept with probability fraction, 
+    or by reservoir sampling of count records
+    """
+    assert (fraction is None) != (count is None), "give fraction or count"
+    rnd = random.Random(seed)
+    index = load_index(infile)
+    if index is not None:
+        if count is None:
+            count = int(round(fraction * index.nrecord))
+        records = rnd.sample(xrange(index.nrecord), min(count, index.nrecord))
+        return iter_indexed_records(infile, index, sorted(records))
+    if not is_gzip(infile):
+        # number of records estimated from leading ones
+        head = [len(fq.as_raw()) for fq in islice(reader_fastq(infile), 1000)]
+        nrecord = os.path.getsize(infile) * len(head) // max(1, sum(head))
+        if count is None:
+            count = int(round(fraction * nrecord))
+        if count * SEEK_SAMPLE_RATIO <= nrecord:
+            return sample_by_offset(infile, count, rnd)
+    return sample_stream(reader_fastq(infile), fraction, count, rnd)
+
+SEEK_SAMPLE_RATIO = 10 # sample by seeking if at most 1/10 of records sampled
+
+def iter_indexed_records(infile, index, records):
+    """Generator of Fastq object of given sorted record numbers"""
+    for i, group in groupby(records, lambda r: r // index.step):
+        end = None
+        if i + 1 < len(index.offsets):
+            end = index.offsets[i+1]
+        reader = reader_fastq(infile, index.offsets[i], end)
+        pos = i * index.step
+        for record in group:
+            yield next(islice(reader, record - pos, None))
+            pos = record + 1
+        reader.close()
+
+def sample_by_offset(infile, count, rnd):
+    """
+    Generator of Fastq object of records at count distinct random offsets,
+    offsets are drawn until count distinct records are found, records
+    are sampled from the stream if not found in count * SEEK_SAMPLE_RATIO 
+    draws (fewer records than estimated)
+    """
+    size = os.path.getsize(infile)
+    with open(infile, 'rb') as fh:
+        offsets = set()
+        ndraw = 0
+        while len(offsets) < count and ndraw < count * SEEK_SAMPLE_RATIO:
+            ndraw += 1
+            offset = sync_fastq(fh, rnd.randrange(size))
+            if offset < size:
+                offsets.add(offset)
+        if len(offsets) < count:
+            for fq in sample_stream(reader_fastq(infile), None, count, rnd):
+                yield fq
+            return
+        for offset in sorted(offsets):
+            fh.seek(offset)
+            for fq in parse_fastq_blocks([''.join(fh.readline() 
+                    for _ in xrange(4))]):
+                yield fq
+
+def sample_stream(records, fraction, count, rnd):
+    """
+    Generator of records sampled from a stream in order, 
+    kept with probability fraction, or count records by reservoir sampling
+    """
+    if count is None:
+        for record in records:
+            if rnd.random() < fraction:
+                yield record
+        return
+    reservoir = []
+    for i, record in enumerate(records):
+        if i < count:
+            reservoir.append((i, record))
+        else:
+            j = rnd.randint(0, i)
+            if j < count:
+                reservoir[j] = (i, record)
+    for i, record in sorted(reservoir):
+        yield record
+
+################################################################################
+
+def split_fastq(infile, nchunk):
+    """
+    Split file into at most nchunk byte ranges [start, end) 
+    aligned to record boundaries, by .fqi index if any,
+    one range for compressed file without index
+    """
+    index = load_index(infile)
+    if index is not None:
+        return index.split(nchunk)
+    if is_gzip(infile):
+        return [(0, None)]
+    size = os.path.getsize(infile)
+    fh = open(infile)
+    offsets = [0]
+    for i in xrange(1, nchunk):
+        offset = sync_fastq(fh, size * i // nchunk)
+        if offset > offsets[-1] and offset < size:
+            offsets.append(offset)
+    fh.close()
+    offsets.append(size)
+    
+    return [(offsets[i], offsets[i+1]) for i in xrange(len(offsets)-1)]
+
 ################################################################################
     
 def rename_fastq(infile, prefix, outfile):
     """Rename tags with given prefix+id (order in original file)"""
     i = 0
-    outhandle = open(outfile, 'w')
+    outhandle = open_file(outfile, 'w')
     for fq in reader_fastq(infile):
         i += 1
         fq.set_name(prefix+str(i))
-        outhandle.write(str(fq)+'\n')
+        outhandle.write(fq.as_raw())
     outhandle.close()
     
 ################################################################################
     
-def filter_fastq(infile, outfile, minlen=6, filterN=False):
+def filter_fastq(infile, outfile, minlen=6, filterN=False, trimN=False,
+    dry_run=0, seed=0, threads=1):
     """
-    Remove tailing Ns;
-    Filter those tags having more than Ns in first given_number nucleotides"""
-    outhandle = open(outfile, 'w')
-    for fq in reader_fastq(infile):
-        keep = True
-        
-        lenseq = len(fq.get_seq())
-        lenqual = len(fq.get_qual())
-        if lenseq != lenqual or lenseq < minlen:
-            keep = False
-        
-        if filterN:
-            if lenseq <= 10:
-                if fq.get_num_N() > 0:
-                    keep = False
-            elif lenseq <= 20:
-                if fq.get_num_N() > 1:
-                    keep = False
-            else:
-                if fq.get_num_N(28) > 2:
-                    keep = False
-             
-        if keep:
-            outhandle.write(str(fq)+'\n')
-    outhandle.close()
+    Filter reads shorter than minlen (or with different length of quality);
+    filterN: filter those having more Ns in first 28 nucleotides than
+        0 (length <= 10), 1 (length <= 20) or 2
+    trimN: remove tailing Ns before filtering
+    Blocks of reads are filtered by NumPy (see filter_block), 
+    in threads worker processes, output in the same order
+    outfile ending with .gz is written compressed
+    dry_run: filter given number of sampled reads without writing outfile
+    Return (number of reads, number of reads kept)"""
+    if dry_run:
+        records = sample_fastq(infile, count=dry_run, seed=seed)
+        blocks = (''.join(fq.as_raw() for fq in batch) 
+            for batch in iter_batches(records, 10000))
+        outhandle = None
+    else:
+        blocks = iter_record_blocks(iter_file_chunks(infile))
+        outhandle = open_file(outfile, 'w')
+    
+    tasks = ((block, minlen, filterN, trimN) for block in blocks)
+    nread = 0
+    nkept = 0
+    for text, num, kept in map_ordered(_filter_block_task, tasks, threads):
+        nread += num
+        nkept += kept
+        if outhandle is not None:
+            outhandle.write(text)
+    if outhandle is not None:
+        outhandle.close()
+    return nread, nkept
+
+def _filter_block_task(args):
+    return filter_block(*args)
+
+def iter_record_blocks(chunks):
+    """Generator of text blocks of whole Fastq records from text chunks"""
+    rest = ''
+    for chunk in chunks:
+        block = rest + chunk
+        count = block.count('\n')
+        if count < 4:
+            rest = block
+            continue
+        end = len(block)
+        for _ in xrange(count % 4 + 1):
+            end = block.rfind('\n', 0, end)
+        yield block[:end+1]
+        rest = block[end+1:]
+    if rest.strip():
+        yield rest
+
+def filter_block(text, minlen=6, filterN=False, trimN=False):
+    """
+    Filter whole Fastq records in text (see filter_fastq),
+    Ns and tailing Ns are found by NumPy over sequences of all records
+    Return (text of kept records, number of records, number kept)
+    """
+    lines = text.split('\n')
+    if '\r' in text:
+        lines = [line.rstrip('\r') for line in lines]
+    nrec = len(lines) // 4
+    if nrec == 0:
+        return '', 0, 0
+    names = lines[0:4*nrec:4]
+    seqs = lines[1:4*nrec:4]
+    pluses = lines[2:4*nrec:4]
+    quals = lines[3:4*nrec:4]
+    for name in names:
+        if name[:1] != '@':
+            raise ValueError("Fastq record not starting with @: %s" % name)
     
+    seqlens = np.fromiter(imap(len, seqs), dtype=np.int64, count=nrec)
+    quallens = np.fromiter(imap(len, quals), dtype=np.int64, count=nrec)
+    ends = np.cumsum(seqlens)
+    starts = ends - seqlens
+    lens = seqlens
+    if filterN or trimN:
+        isN = np.frombuffer(''.join(seqs), dtype=np.uint8) == ord('N')
+    if trimN:
+        # last non-N base before end of each record, -1 as sentinel
+        nonN = np.concatenate(([-1], np.flatnonzero(~isN)))
+        last = nonN[np.searchsorted(nonN, ends) - 1]
+        lens = np.maximum(last + 1 - starts, 0)
+    keep = (seqlens == quallens) & (lens >= minlen)
+    if filterN:
+        cumN = np.concatenate(([0], np.cumsum(isN)))
+        numN = cumN[starts + np.minimum(lens, 28)] - cumN[starts]
+        maxN = np.where(lens <= 10, 0, np.where(lens <= 20, 1, 2))
+        keep &= numN <= maxN
+    
+    kept = np.flatnonzero(keep).tolist()
+    if len(kept) == nrec and (lens == seqlens).all() and '\r' not in text:
+        if not text.endswith('\n'):
+            text += '\n'
+        return text, nrec, nrec
+    trimmed = set(np.flatnonzero(lens < seqlens).tolist())
+    out = []
+    for i in kept:
+        if i in trimmed:
+            n = int(lens[i])
+            out.append('%s\n%s\n%s\n%s\n' % (names[i], seqs[i][:n], 
+                pluses[i], quals[i][:n]))
+        else:
+            out.append('%s\n%s\n%s\n%s\n' % (names[i], seqs[i], pluses[i], 
+                quals[i]))
+    return ''.join(out), nrec, len(kept)
+
 ################################################################################
 
+def dropend_fastq(infile, outfile, drop5=0, drop3=0, minlen=0, threads=1):
+    """
+    Drop given number of bases at 5'-end and 3'-end of reads, 
+    and reads shorter than minlen after dropping
+    Blocks of reads are processed in threads worker processes,
+    output in the same order
+    outfile ending with .gz is written compressed, stdout if None
+    Return (number of reads, number of reads shorter than minlen)
+    """
+    blocks = iter_record_blocks(iter_file_chunks(infile))
+    tasks = ((block, drop5, drop3, minlen) for block in blocks)
+    outhandle = open_file(outfile, 'w') if outfile else sys.stdout
+    nread = 0
+    nshort = 0
+    for text, num, short in map_ordered(_dropend_block_task, tasks, threads):
+        nread += num
+        nshort += short
+        outhandle.write(text)
+    if outfile:
+        outhandle.close()
+    return nread, nshort
+
+def _dropend_block_task(args):
+    return dropend_block(*args)
+
+def dropend_block(text, drop5=0, drop3=0, minlen=0):
+    """
+    Drop end bases of whole Fastq records in text (see dropend_fastq)
+    Return (text of kept records, number of records, number of short records)
+    """
+    lines = text.split('\n')
+    if '\r' in text:
+        lines = [line.rstrip('\r') for line in lines]
+    out = []
+    nshort = 0
+    for i in xrange(0, len(lines) // 4 * 4, 4):
+        name, seq, plus, qual = lines[i:i+4]
+        if name[:1] != '@':
+            raise ValueError("Fastq record not starting with @: %s" % name)
+        end = max(0, len(seq) - drop3)
+        if max(0, end - drop5) < minlen:
+            nshort += 1
+            continue
+        out.append('%s\n%s\n%s\n%s\n' % (name, seq[drop5:end], plus, 
+            qual[drop5:end]))
+    return ''.join(out), len(lines) // 4, nshort
+
+################################################################################
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""
+Fast reading of GTF annotation: only requested attributes are parsed,
+repeated strings (chromosomes, feature types, attribute values) are interned
+"""
+
+from maps.io_utils.bgzf import open_file
+
+################################################################################
+
+def find_attr(text, key):
+    """
+    Return value of attribute key in GTF attribute column,
+    e.g. 'gene_id "g1"; cluster_id "1";', None if missing
+    """
+    i = text.find(key)
+    while i >= 0:
+        j = i + len(key)
+        if (i == 0 or text[i-1] in '; ') and text[j:j+1] == ' ':
+            k = text.find(';', j)
+            if k < 0:
+                k = len(text)
+            return text[j:k].strip().strip('"')
+        i = text.find(key, j)
+    return None
+
+def parse_attrs(text, attrs):
+    """Return tuple of values of given attributes (see find_attr)"""
+    return tuple(find_attr(text, key) for key in attrs)
+
+def reader_gtf(filename, attrs=(), feature_type=None, required=None):
+    """
+    Generator of (chrom, feature type, start, end, strand, attribute values)
+    of GTF file (gzip supported), start 0-based and end exclusive as
+    HTSeq.GFF_Reader, attribute values a tuple in order of given attrs
+    feature_type: only records of this type if given
+    required: records of this type (feature_type by default) missing any
+        of attrs raise ValueError, other missing attributes are None
+    """
+    if required is None:
+        required = feature_type
+    strings = {} # one object per distinct string
+    intern = lambda s: strings.setdefault(s, s)
+    fh = open_file(filename)
+    try:
+        for lineno, line in enumerate(fh, 1):
+            if line.startswith('#') or line.startswith('track'):
+                continue
+            fields = line.rstrip('\r\n').split('\t', 8)
+            if len(fields) < 8:
+                continue
+            if feature_type is not None and fields[2] != feature_type:
+                continue
+            text = fields[8] if len(fields) > 8 else ''
+            values = []
+            for key in attrs:
+                value = find_attr(text, key)
+                if value is None and fields[2] == required:
+                    raise ValueError("%s: no attribute %s at line %d" % (
+                        filename, key, lineno))
+                values.append(value if value is None else intern(value))
+            yield (intern(fields[0]), intern(fields[2]), int(fields[3]) - 1,
+                int(fields[4]), intern(fields[6]), tuple(values))
+    finally: # also if stopped early, to end decompressing thread of gzip
+        fh.close()
+
+################################################################################
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""
+Buffered writing to many output files with bounded open file handles
+"""
+
+import shutil
+from collections import OrderedDict
+from maps.io_utils.bgzf import open_file, copy_compressed, BGZF_EOF
+
+################################################################################
+
+class OutputPool(object):
+    """
+    Output files by key, each with an in-memory buffer flushed in bulk.
+    At most max_open files are open, the least recently used one is closed
+    and reopened in append mode when written again.
+    Files ending with .gz are written in BGZF.
+    """
+    def __init__(self, max_open=256, bufsize=1<<18, maxbuf=1<<28):
+        """
+        max_open: maximum number of open files
+        bufsize: buffered bytes of one file to trigger flush
+        maxbuf: buffered bytes of all files to trigger flush of all
+        """
+        assert max_open > 0, "max_open should be > 0"
+        self.max_open = max_open
+        self.bufsize = bufsize
+        self.maxbuf = maxbuf
+        self.key2file = {}
+        self.key2buf = {}
+        self.key2size = {}
+        self.totalsize = 0
+        self.handles = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.key2file
+
+    def add(self, key, filename):
+        """Add output file of given key, truncate it"""
+        assert key not in self.key2file, "%s already added" % key
+        open(filename, 'w').close()
+        self.key2file[key] = filename
+        self.key2buf[key] = []
+        self.key2size[key] = 0
+
+    def get_file(self, key):
+        return self.key2file[key]
+
+    def write(self, key, data):
+        """Buffer data of given key"""
+        self.key2buf[key].append(data)
+        self.key2size[key] += len(data)
+        self.totalsize += len(data)
+        if self.key2size[key] >= self.bufsize:
+            self.flush(key)
+        elif self.totalsize >= self.maxbuf:
+            self.flush()
+
+    def handle(self, key):
+        """Return open handle of given key, close least recently used one"""
+        if key in self.handles:
+            oh = self.handles.pop(key)
+        else:
+            if len(self.handles) >= self.max_open:
+                self._close(*self.handles.popitem(last=False))
+            oh = open_file(self.key2file[key], 'a')
+        self.handles[key] = oh
+        return oh
+
+    def _is_bgzf(self, key):
+        return self.key2file[key].endswith('.gz')
+
+    def _close(self, key, oh):
+        """Close handle, BGZF EOF marker is only written by close()"""
+        if self._is_bgzf(key):
+            oh.close(eof=False)
+        else:
+            oh.close()
+
+    def flush(self, key=None):
+        """Write buffered data of given key, or all keys if None"""
+        if key is None:
+            for k in self.key2buf:
+                if self.key2size[k]:
+                    self.flush(k)
+            return
+        if not self.key2size[key]:
+            return
+        self.handle(key).write(''.join(self.key2buf[key]))
+        self.key2buf[key] = []
+        self.totalsize -= self.key2size[key]
+        self.key2size[key] = 0
+
+    def append_file(self, key, infile):
+        """Append content of file (compressed if .gz) to output of key"""
+        self.flush(key)
+        oh = self.handle(key)
+        if self._is_bgzf(key):
+            copy_compressed(infile, oh)
+        else:
+            with open(infile, 'rb') as ih:
+                shutil.copyfileobj(ih, oh)
+
+    def close(self):
+        """Flush and close all, end BGZF files with EOF marker"""
+        self.flush()
+        while self.handles:
+            self._close(*self.handles.popitem(last=False))
+        for key in self.key2file:
+            if self._is_bgzf(key):
+                with open(self.key2file[key], 'ab') as oh:
+                    oh.write(BGZF_EOF)
+
+################################################################################
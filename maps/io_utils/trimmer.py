@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+"""
+Trimming 3'-adaptor, polyA tail and low quality bases of Fastq reads
+in one pass
+"""
+
+from collections import defaultdict
+from maps.io_utils.fastq import reader_fastq
+from maps.io_utils.bgzf import open_file
+
+################################################################################
+
+class Trimmer(object):
+    """
+    Trimmer of 3'-end of reads, in order of
+    low quality bases (as BWA/cutadapt -q), 3'-adaptor, polyA tail
+    """
+    def __init__(self, adapter=None, error_rate=0.1, min_overlap=3,
+        seedlen=6, min_polya=0, qual_cutoff=0, qual_base=33):
+        """
+        adapter: 3'-adaptor sequence
+        error_rate: maximum rate of mismatches in adaptor match
+        min_overlap: minimum length of partial adaptor at 3'-end
+        seedlen: length of two exact seeds from adaptor start, adaptor
+            matches with at most one mismatch in seeds are found
+        min_polya: minimum length of polyA tail to trim, 0 for no trim
+        qual_cutoff: quality cutoff, 0 for no trim
+        qual_base: ascii offset of quality
+        """
+        self.adapter = adapter
+        self.error_rate = error_rate
+        self.min_overlap = min_overlap
+        self.min_polya = min_polya
+        self.qual_cutoff = qual_cutoff
+        self.qual_base = qual_base
+        self.seeds = []
+        self.seedspan = 0
+        if adapter:
+            seedlen = max(1, min(seedlen, len(adapter) // 2))
+            self.seeds = [(0, adapter[:seedlen])]
+            if len(adapter) >= 2 * seedlen:
+                self.seeds.append((seedlen, adapter[seedlen:2*seedlen]))
+            self.seedspan = seedlen * len(self.seeds)
+
+    def match_adapter(self, seq, start):
+        """Whether adaptor matches sequence from start within error rate"""
+        adapter = self.adapter
+        overlap = min(len(adapter), len(seq) - start)
+        maxerr = int(overlap * self.error_rate)
+        err = 0
+        for i in xrange(overlap):
+            if seq[start+i] != adapter[i]:
+                err += 1
+                if err > maxerr:
+                    return False
+        return True
+
+    def find_adapter(self, seq):
+        """Return start of adaptor in sequence, None if not found"""
+        starts = set()
+        for offset, seed in self.seeds:
+            i = seq.find(seed)
+            while i >= 0:
+                if i >= offset:
+                    starts.add(i - offset)
+                i = seq.find(seed, i + 1)
+        for start in sorted(starts):
+            if self.match_adapter(seq, start):
+                return start
+        # partial adaptor at 3'-end, shorter than seeds
+        for start in xrange(max(0, len(seq) - self.seedspan + 1),
+                len(seq) - self.min_overlap + 1):
+            if self.match_adapter(seq, start):
+                return start
+        return None
+
+    def find_polya(self, seq, end):
+        """
+        Return end of sequence before polyA tail of seq[:end],
+        As score +1 and others -2 from 3'-end, tail is at maximum score
+        """
+        if end == 0 or seq[end-1] != 'A':
+            return end
+        score = 0
+        maxscore = 0
+        best = end
+        for i in xrange(end-1, -1, -1):
+            if seq[i] == 'A':
+                score += 1
+                if score > maxscore:
+                    maxscore = score
+                    best = i
+            else:
+                score -= 2
+                if score < 0:
+                    break
+        if end - best >= self.min_polya:
+            return best
+        return end
+
+    def find_quality(self, qual, end):
+        """Return end of quality qual[:end] after trimming low quality bases"""
+        cutoff = self.qual_cutoff + self.qual_base
+        score = 0
+        maxscore = 0
+        best = end
+        for i in xrange(end-1, -1, -1):
+            score += cutoff - ord(qual[i])
+            if score < 0:
+                break
+            if score > maxscore:
+                maxscore = score
+                best = i
+        return best
+
+    def trim(self, record):
+        """
+        Trim given Fastq record in place
+        Return tuple of trimmed length by quality, adaptor, polyA
+        """
+        seq = record.get_seq()
+        length = len(seq)
+        qend = length
+        if self.qual_cutoff:
+            qend = self.find_quality(record.get_qual(), length)
+        aend = qend
+        if self.adapter:
+            idx = self.find_adapter(seq[:qend] if qend < length else seq)
+            if idx is not None:
+                aend = idx
+        pend = aend
+        if self.min_polya:
+            pend = self.find_polya(seq, aend)
+        if pend < length:
+            record.trim(0, pend)
+        return (length - qend, qend - aend, aend - pend)
+
+################################################################################
+
+TRIM_KINDS = ('quality', 'adapter', 'polya')
+
+def trim_fastq(infile, outfile, trimmer, minlen=0):
+    """
+    Trim reads of file and write those not shorter than minlen
+    Return (hists, nshort): dict of histograms of trimmed length, total 
+    and by kind (quality, adapter, polya), and number of short reads
+    """
+    hists = dict((name, defaultdict(int)) for name in ('trimmed', ) +
+        tuple('trimmed_' + kind for kind in TRIM_KINDS))
+    nshort = 0
+    outhandle = open_file(outfile, 'w')
+    for fq in reader_fastq(infile):
+        lens = trimmer.trim(fq)
+        total = sum(lens)
+        if total:
+            hists['trimmed'][total] += 1
+            for kind, tlen in zip(TRIM_KINDS, lens):
+                if tlen:
+                    hists['trimmed_' + kind][tlen] += 1
+        if fq.get_length() < minlen:
+            nshort += 1
+            continue
+        outhandle.write(fq.as_raw())
+    outhandle.close()
+
+    return hists, nshort
+
+################################################################################
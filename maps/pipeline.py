@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""
+Streaming pipeline of decoded reads:
+decode -> drop end -> 3'-adaptor/polyA trim -> length filter,
+records are passed between stages in memory,
+only the final Fastq files per sample are written (see Decoder stages)
+"""
+
+from maps.io_utils.trimmer import Trimmer, TRIM_KINDS
+
+################################################################################
+
+class Stage(object):
+    """
+    Stage of pipeline: generator over stream of (barcode, Fastq)
+    Reads failed in decoding are passed untouched
+    """
+    def __call__(self, items, stats):
+        """
+        items: iterable of (barcode or 'failed', Fastq)
+        stats: DecodeStats to add counters/histograms of the stage
+        """
+        for bc, record in items:
+            if bc != "failed":
+                record = self.process(record, stats)
+                if record is None:
+                    continue
+            yield bc, record
+
+    def process(self, record, stats):
+        """Return processed record, None to drop it"""
+        raise Exception("Abstract method, not to be called")
+
+################################################################################
+
+class DropEnd(Stage):
+    """Drop given number of bases at 5'-end and 3'-end"""
+    def __init__(self, drop5=0, drop3=0):
+        self.drop5 = drop5
+        self.drop3 = drop3
+
+    def process(self, record, stats):
+        end = None
+        if self.drop3:
+            end = max(0, record.get_length() - self.drop3)
+        record.trim(self.drop5, end)
+        return record
+
+################################################################################
+
+class TrimTail(Stage):
+    """
+    Trim low quality bases, 3'-adaptor and polyA tail at 3'-end 
+    by given Trimmer, histograms of trimmed length are added to stats
+    """
+    def __init__(self, trimmer):
+        self.trimmer = trimmer
+
+    def process(self, record, stats):
+        lens = self.trimmer.trim(record)
+        total = sum(lens)
+        if total:
+            stats.hist('trimmed', total)
+            for kind, tlen in zip(TRIM_KINDS, lens):
+                if tlen:
+                    stats.hist('trimmed_' + kind, tlen)
+        return record
+
+################################################################################
+
+class MinLength(Stage):
+    """Drop reads shorter than given length"""
+    def __init__(self, minlen):
+        self.minlen = minlen
+
+    def process(self, record, stats):
+        if record.get_length() < self.minlen:
+            stats.incr('short')
+            return None
+        return record
+
+################################################################################
+
+def make_stages(drop5=0, drop3=0, adapter=None, min_polya=0, minlen=0,
+    error_rate=0.1, qual_cutoff=0):
+    """Return list of stages for given settings, in pipeline order"""
+    stages = []
+    if drop5 or drop3:
+        stages.append(DropEnd(drop5, drop3))
+    if adapter or min_polya or qual_cutoff:
+        stages.append(TrimTail(Trimmer(adapter, error_rate=error_rate, 
+            min_polya=min_polya, qual_cutoff=qual_cutoff)))
+    if minlen:
+        stages.append(MinLength(minlen))
+    return stages
+
+################################################################################
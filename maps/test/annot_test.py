@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+import random
+import shutil
+import tempfile
+import unittest
+import HTSeq
+from maps.annot import AnnotIndex, StepCursor
+
+###############################################################################
+
+def random_intervals(num, seed=0):
+    rnd = random.Random(seed)
+    intervals = []
+    for i in xrange(num):
+        start = rnd.randint(0, 2000)
+        intervals.append(('chr%d' % rnd.randint(1, 2), start, 
+            start + rnd.randint(1, 300), rnd.choice('+-'), 'f%d' % (i % 40)))
+    return intervals
+
+def gas_features(gas, blocks):
+    """Intersection-strict features of blocks by HTSeq, as in DGE"""
+    fs = None
+    for chrom, strand, start, end in blocks:
+        if chrom not in gas.chrom_vectors:
+            continue
+        iv = HTSeq.GenomicInterval(chrom, start, end, strand)
+        for step in gas[iv].steps():
+            if fs is None:
+                fs = step[1].copy()
+            else:
+                fs = fs.intersection(step[1])
+    return fs
+
+class AnnotIndex_Test(unittest.TestCase):
+    def setUp(self):
+        self.intervals = random_intervals(100)
+        self.index = AnnotIndex.build(self.intervals, ['chr3'])
+        self.gas = HTSeq.GenomicArrayOfSets([], stranded=True)
+        for chrom in ('chr1', 'chr2', 'chr3'):
+            self.gas.add_chrom(chrom)
+        for chrom, start, end, strand, feature in self.intervals:
+            self.gas[HTSeq.GenomicInterval(chrom, start, end, strand)] += feature
+
+    def test_lookup(self):
+        index = AnnotIndex.build([('c', 10, 20, '+', 'a'), 
+            ('c', 15, 30, '+', 'b'), ('c', 40, 50, '+', 'a')])
+        fsets = index.fsets
+        assert fsets[index.lookup('c', '+', 10, 20)] == set(['a'])
+        assert fsets[index.lookup('c', '+', 16, 19)] == set(['a', 'b'])
+        assert fsets[index.lookup('c', '+', 18, 25)] == set(['b'])
+        assert index.lookup('c', '+', 5, 12) == 0
+        assert index.lookup('c', '+', 25, 45) == 0
+        assert index.lookup('c', '-', 10, 20) == 0
+        assert index.lookup('c', '+', 50, 50) == 0
+        assert index.lookup('c', '+', 15, 15) == 0
+        assert index.lookup_blocks([('d', '+', 10, 20)]) is None
+        assert fsets[index.lookup_blocks([('c', '+', 10, 12), 
+            ('d', '+', 0, 5), ('c', '+', 41, 45)])] == set(['a'])
+
+    def test_sets(self):
+        index = AnnotIndex.build([('c', 0, 100, '+', 'a'), 
+            ('c', 0, 200, '+', 'b'), ('c', 50, 200, '+', 'c')])
+        other = AnnotIndex.build([('c', 0, 100, '+', 'a'), 
+            ('c', 0, 200, '+', 'b'), ('c', 50, 200, '+', 'c')])
+        fsid = index.lookup('c', '+', 40, 110) # {b} is not a step set
+        assert fsid >= len(other.fsets)
+        fset2count = index.to_sets({fsid:2, 0:1})
+        assert fset2count == {frozenset(['b']):2, frozenset():1}
+        fsid2count = other.from_sets(fset2count)
+        assert dict((other.fsets[i], n) for i, n in fsid2count.items()) == \
+            fset2count
+
+    def test_random(self):
+        rnd = random.Random(1)
+        for _ in xrange(2000):
+            blocks = []
+            for _ in xrange(rnd.randint(1, 3)):
+                start = rnd.randint(0, 2400)
+                blocks.append((rnd.choice(['chr1', 'chr2', 'chr3', 'chr4']),
+                    rnd.choice('+-'), start, start + rnd.randint(1, 50)))
+            expected = gas_features(self.gas, blocks)
+            fsid = self.index.lookup_blocks(blocks)
+            if expected is None:
+                assert fsid is None
+            else:
+                assert self.index.fsets[fsid] == expected, blocks
+
+    def test_lookup_points(self):
+        positions = range(-5, 2500, 7)
+        for chrom in ('chr1', 'chr3', 'chr4'):
+            for strand in '+-':
+                fsids = self.index.lookup_points(chrom, strand, positions)
+                expected = [self.index.lookup(chrom, strand, pos, pos + 1)
+                    for pos in positions]
+                assert list(fsids) == expected
+        assert len(self.index.lookup_points('chr1', '+', [])) == 0
+
+    def test_regions(self):
+        index = AnnotIndex.build([('c', 10, 20, '+', 'a'), 
+            ('c', 15, 30, '-', 'b'), ('c', 30, 35, '+', 'c'), 
+            ('c', 40, 50, '+', 'a'), ('d', 5, 8, '-', 'd')], ['e'])
+        assert index.regions() == {'c':[(10, 35), (40, 50)], 'd':[(5, 8)]}
+        assert index.regions(5)['c'] == [(10, 50)]
+        index = self.index
+        for chrom, regions in index.regions().iteritems():
+            for strand in '+-':
+                for start, end in regions:
+                    assert index.lookup(chrom, strand, start - 1, start) == 0
+                    assert index.lookup(chrom, strand, end, end + 1) == 0
+
+    def test_cursor(self):
+        rnd = random.Random(3)
+        reads = []
+        for _ in xrange(2000):
+            start = rnd.randint(0, 2400)
+            blocks = [(start, start + rnd.randint(1, 50))]
+            if rnd.random() < 0.3:
+                start = blocks[0][1] + rnd.randint(1, 500)
+                blocks.append((start, start + rnd.randint(1, 50)))
+            reads.append(blocks)
+        reads.sort()
+        reads += reads[:100] # out of order
+        for chrom in ('chr1', 'chr3'):
+            for strand in '+-':
+                cursor = StepCursor(self.index, chrom, strand)
+                for blocks in reads:
+                    expected = self.index.lookup_blocks([(chrom, strand, 
+                        start, end) for start, end in blocks])
+                    assert cursor.lookup_blocks(blocks) == expected, blocks
+
+    def test_save_load(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            self.index.save(tmpdir)
+            loaded = AnnotIndex.load(tmpdir)
+            assert list(loaded.steps()) == list(self.index.steps())
+            rnd = random.Random(2)
+            for _ in xrange(500):
+                start = rnd.randint(0, 2400)
+                blocks = [('chr1', '+', start, start + 20), 
+                    ('chr1', '+', start + 50, start + 60)]
+                assert (loaded.fsets[loaded.lookup_blocks(blocks)] == 
+                    self.index.fsets[self.index.lookup_blocks(blocks)])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_steps(self):
+        length = {}
+        for chrom, strand, start, end, fs in self.index.steps():
+            for f in fs:
+                length[f] = length.get(f, 0) + end - start
+        expected = {}
+        for iv, fs in self.gas.steps():
+            for f in fs:
+                expected[f] = expected.get(f, 0) + iv.length
+        assert length == expected
+
+###############################################################################
+
+if __name__ == '__main__':
+    unittest.main(testRunner=unittest.TextTestRunner(verbosity=2))
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+
+import os
+import json
+import gzip
+import shutil
+import tempfile
+import unittest
+from itertools import product
+from maps.barcode import (barcode_neighbors, barcode_neighborhood,
+    Decoder, DecoderExact, DecoderHash, DecoderMulti, DecoderNumpy, BarcodeTable)
+from maps.io_utils.fastq import index_fastq
+from maps.io_utils.bgzf import BgzfWriter
+from fastq_test import random_fastq
+
+###############################################################################
+
+barcode2name = {'ACGT':'s1', 'ACGA':'s2', 'TTTT':'s3', 'GGCC':'s4'}
+
+class Neighborhood_Test(unittest.TestCase):
+    def test_barcode_neighbors(self):
+        seqs = [s for s, d in barcode_neighbors('AC', 1, 'ACGT')]
+        assert len(seqs) == len(set(seqs)) == 7
+        assert dict(barcode_neighbors('AC', 2, 'ACGT'))['CA'] == 2
+
+    def test_barcode_neighborhood(self):
+        seq2hit = barcode_neighborhood(barcode2name, 1)
+        assert seq2hit['ACGT'] == ('ACGT', 0)
+        assert seq2hit['ACGC'] == (None, 1)
+        assert seq2hit['TTTA'] == ('TTTT', 1)
+        assert 'TTAA' not in seq2hit
+
+    def test_barcode_table(self):
+        table = BarcodeTable(barcode2name, 1)
+        assert table.lookup('ACGT') == ('ACGT', 0)
+        assert table.lookup('ACGC') == (None, 1)
+        assert table.lookup('TTXT') == ('TTTT', 1)
+        assert table.lookup('AXXT') == (None, None)
+        assert table.lookup('ACG') == (None, None)
+
+###############################################################################
+
+class DecoderHash_Test(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.infile = os.path.join(self.tmpdir, 'lane.fastq')
+        open(self.infile, 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_decode_one(self):
+        for mismatch in (0, 1, 2):
+            dc = Decoder(self.infile, barcode2name, mismatch=mismatch)
+            dh = DecoderHash(self.infile, barcode2name, mismatch=mismatch)
+            for seq in product('ACGTN', repeat=4):
+                seq = ''.join(seq)
+                assert dh.decode_one(seq) == dc.decode_one(seq), seq
+            assert dh.decode_one('ACGX') == dc.decode_one('ACGX')
+            assert dh.decode_one('AC') == 'failed'
+
+    def test_decode_batch(self):
+        seqs = [''.join(seq) for seq in product('ACGTN', repeat=4)]
+        seqs += ['ACGX', 'AC', '']
+        for mismatch in (0, 1, 2):
+            dc = Decoder(self.infile, barcode2name, mismatch=mismatch)
+            dn = DecoderNumpy(self.infile, barcode2name, mismatch=mismatch)
+            expected = [dc.decode_hit(seq) if len(seq) == 4 else (None, None)
+                for seq in seqs]
+            assert dn.decode_batch(seqs) == expected
+
+    def test_exact(self):
+        de = DecoderExact(self.infile, barcode2name, mismatch=0)
+        dh = DecoderHash(self.infile, barcode2name, mismatch=0)
+        for seq in product('ACGTN', repeat=4):
+            seq = ''.join(seq)
+            assert dh.decode_one(seq) == de.decode_one(seq), seq
+
+###############################################################################
+
+class DecoderMulti_Test(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.infile = os.path.join(self.tmpdir, 'lane.fastq')
+        open(self.infile, 'w').close()
+        self.barcode2name = {'ACGT+AAC':'s1', 'ACGT+GGT':'s2', 'TTTT+AAC':'s3'}
+        self.dm = DecoderMulti(self.infile, self.barcode2name, 
+            [(1, 4, 1), (8, 3, 0)], outprefix=os.path.join(self.tmpdir, 'o'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_tables(self):
+        assert [t.barcodes for t in self.dm.tables] == [
+            ['ACGT', 'TTTT'], ['AAC', 'GGT']]
+
+    def test_decode_one(self):
+        dm = self.dm
+        assert dm.decode_one(dm.extract('ACGTNNNAAC')) == 'ACGT+AAC'
+        assert dm.decode_one(dm.extract('ACGANNNGGT')) == 'ACGT+GGT'
+        assert dm.decode_one(dm.extract('ACGTNNNAAG')) == 'failed'
+        assert dm.decode_one(dm.extract('TTTTNNNGGT')) == 'failed'
+        assert dm.decode_one(dm.extract('TTTTNNN')) == 'failed'
+
+    def test_outfile(self):
+        assert sorted(os.listdir(self.tmpdir)) == ['lane.fastq', 
+            'o.failed.m1-0', 'o.s1.m1-0', 'o.s2.m1-0', 'o.s3.m1-0']
+
+###############################################################################
+
+class DecoderParallel_Test(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.infile = os.path.join(self.tmpdir, 'lane.fastq')
+        with open(self.infile, 'w') as oh:
+            oh.write(random_fastq(2000, length=12))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_decode(self):
+        serial = os.path.join(self.tmpdir, 'serial')
+        parallel = os.path.join(self.tmpdir, 'parallel')
+        dc = DecoderHash(self.infile, barcode2name, mismatch=1, startpos=3,
+            outprefix=serial)
+        dc.decode()
+        dc = DecoderHash(self.infile, barcode2name, mismatch=1, startpos=3,
+            outprefix=parallel)
+        dc.decode(threads=3)
+        for name in barcode2name.values() + ['failed']:
+            obs = open('%s.%s.m1' % (parallel, name)).read()
+            assert obs == open('%s.%s.m1' % (serial, name)).read()
+        assert len(os.listdir(self.tmpdir)) == 13
+        obs = json.load(open(parallel+'.decode.json'))
+        expected = json.load(open(serial+'.decode.json'))
+        for stats in (obs, expected):
+            del stats['seconds'], stats['reads_per_sec']
+        assert obs == expected
+
+    def test_decode_stats(self):
+        outprefix = os.path.join(self.tmpdir, 'serial')
+        dc = DecoderHash(self.infile, barcode2name, mismatch=1, startpos=3,
+            outprefix=outprefix)
+        dc.decode()
+        stats = json.load(open(outprefix+'.decode.json'))
+        assert stats['reads'] == 2000
+        assert stats['reads'] == stats['ambiguous'] + stats['failed'] + sum(
+            s['reads'] for s in stats['samples'].values())
+        assert sum(stats['mismatch'].values()) == sum(
+            s['reads'] for s in stats['samples'].values())
+        nreads = len(open(outprefix+'.s1.m1').readlines()) // 4
+        assert stats['samples']['s1'] == {'barcode':'ACGT', 'reads':nreads}
+        nreads = len(open(outprefix+'.failed.m1').readlines()) // 4
+        assert stats['ambiguous'] + stats['failed'] == nreads
+        assert len(stats['top_failed']) == 20
+
+    def test_decode_max_open(self):
+        serial = os.path.join(self.tmpdir, 'serial')
+        bounded = os.path.join(self.tmpdir, 'bounded')
+        dc = DecoderHash(self.infile, barcode2name, mismatch=1, startpos=3,
+            outprefix=serial)
+        dc.decode()
+        dc = DecoderHash(self.infile, barcode2name, mismatch=1, startpos=3,
+            outprefix=bounded, max_open=2)
+        dc.outpool.bufsize = 64
+        dc.decode()
+        for name in barcode2name.values() + ['failed']:
+            obs = open('%s.%s.m1' % (bounded, name)).read()
+            assert obs == open('%s.%s.m1' % (serial, name)).read()
+
+    def test_decode_numpy(self):
+        serial = os.path.join(self.tmpdir, 'serial')
+        batch = os.path.join(self.tmpdir, 'batch')
+        dc = DecoderHash(self.infile, barcode2name, mismatch=1, startpos=3,
+            outprefix=serial)
+        dc.decode()
+        dc = DecoderNumpy(self.infile, barcode2name, mismatch=1, startpos=3,
+            outprefix=batch, batchsize=300)
+        dc.decode(threads=2)
+        for name in barcode2name.values() + ['failed']:
+            obs = open('%s.%s.m1' % (batch, name)).read()
+            assert obs == open('%s.%s.m1' % (serial, name)).read()
+
+    def test_decode_compress(self):
+        serial = os.path.join(self.tmpdir, 'serial')
+        parallel = os.path.join(self.tmpdir, 'parallel')
+        dc = DecoderHash(self.infile, barcode2name, mismatch=1, startpos=3,
+            outprefix=serial)
+        dc.decode()
+        dc = DecoderHash(self.infile, barcode2name, mismatch=1, startpos=3,
+            outprefix=parallel, compress=True)
+        dc.decode(threads=3)
+        for name in barcode2name.values() + ['failed']:
+            obs = gzip.open('%s.%s.m1.gz' % (parallel, name)).read()
+            assert obs == open('%s.%s.m1' % (serial, name)).read()
+
+    def test_decode_sample(self):
+        outprefix = os.path.join(self.tmpdir, 'dry')
+        dc = DecoderHash(self.infile, barcode2name, mismatch=1, startpos=3,
+            outprefix=outprefix, dry_run=True)
+        stats = dc.decode_sample(count=300)
+        assert os.listdir(self.tmpdir) == ['lane.fastq']
+        stats = stats.as_dict(barcode2name)
+        assert stats['reads'] == 300
+        decoded = sum(s['reads'] for s in stats['samples'].values())
+        assert sum(stats['hists']['length'].values()) == decoded
+        assert min(stats['hists']['length']) >= 6
+        self.assertRaises(AssertionError, dc.decode)
+        assert os.listdir(self.tmpdir) == ['lane.fastq']
+
+    def test_decode_bgzf_index(self):
+        serial = os.path.join(self.tmpdir, 'serial')
+        parallel = os.path.join(self.tmpdir, 'parallel')
+        gzfile = os.path.join(self.tmpdir, 'lane.fastq.gz')
+        oh = BgzfWriter(gzfile)
+        oh.write(open(self.infile).read())
+        oh.close()
+        index_fastq(gzfile, step=100)
+        dc = DecoderHash(self.infile, barcode2name, mismatch=1, startpos=3,
+            outprefix=serial)
+        dc.decode()
+        dc = DecoderHash(gzfile, barcode2name, mismatch=1, startpos=3,
+            outprefix=parallel)
+        dc.decode(threads=3)
+        for name in barcode2name.values() + ['failed']:
+            obs = open('%s.%s.m1' % (parallel, name)).read()
+            assert obs == open('%s.%s.m1' % (serial, name)).read()
+
+###############################################################################
+
+if __name__ == '__main__':
+    unittest.main(testRunner=unittest.TextTestRunner(verbosity=2))
+
@@ -1,8 +1,14 @@
 #!/usr/bin/env python
 
+import os
+import random
+import shutil
+import tempfile
 import unittest
 import HTSeq
-from maps.exp import Counter, DGE
+import pysam
+from maps.exp import (Counter, DGE, DGEMatrix, FLAG_SECONDARY, 
+    FLAG_SUPPLEMENTARY)
 
 ###############################################################################
 
@@ -73,12 +79,308 @@ class DGE_Test(unittest.TestCase):
         self.dc.count_unique()
         self.dc.count_shared()
         assert self.dc.cid2counter['1'].shared == 1 # 
+        de = DGE("data/read.bam", "data/gene.gtf", feature_type="exon", 
+            id_feature="gene_id", id_count="gene_id", split='em')
+        de.count_shared()
+        assert de.cid2counter['g2'].shared == 0.5
+        
+    def test_split_em(self):
+        rnd = random.Random(0)
+        dge = self.dg
+        dge.fid2cid = dict(('f%d' % i, 'c%d' % (i // 2)) for i in range(20))
+        dge.fsets = [tuple(rnd.sample(sorted(dge.fid2cid), rnd.randint(2, 4)))
+            for _ in range(30)]
+        dge.fsetcounts = [rnd.randint(1, 50) for _ in dge.fsets]
+        for cid in sorted(dge.cid2counter):
+            dge.cid2counter[cid].unique = rnd.randint(0, 20)
+        
+        def split(method, *args):
+            for c in dge.cid2counter.values():
+                c.shared = 0
+            method(*args)
+            return dict((cid, c.shared) for cid, c in dge.cid2counter.items())
+        
+        def close(obs, expected):
+            return all(abs(obs[cid] - expected[cid]) < 1e-6 for cid in obs)
+        
+        expected = dict.fromkeys(dge.cid2counter, 0.0)
+        for i in range(20): # EM of one read set at a time
+            shared = dict.fromkeys(dge.cid2counter, 0.0)
+            for fs, num in zip(dge.fsets, dge.fsetcounts):
+                cids = [dge.fid2cid[f] for f in fs]
+                weights = [dge.cid2counter[cid].unique + expected[cid] + 1 
+                    for cid in cids]
+                for cid, w in zip(cids, weights):
+                    shared[cid] += num * w / float(sum(weights))
+            expected = shared
+            if i == 0:
+                assert close(split(dge.split_em, 0, 1), expected)
+                assert close(split(dge.split_prior), expected)
+        assert close(split(dge.split_em, 0, 20), expected)
+        obs = split(dge.split_em)
+        assert abs(sum(obs.values()) - sum(dge.fsetcounts)) < 1e-6
+        assert dge.split_em(0.001) < 1000
+        
+    def test_feature_sets(self):
+        self.dg.count_unique()
+        assert [sorted(fs) for fs in self.dg.fsets] == [['g1', 'g2']]
+        assert sum(self.dg.fsetcounts) == self.dg.nshared
+        self.dg.iter_reads = None # shared reads are not read again
+        self.dg.count_shared()
+        assert self.dg.cid2counter['g1'].shared == 0.5
+        
+    def test_count_parallel(self):
+        self.dc.count_unique(threads=2)
+        self.dc.count_shared()
+        self.dg.count_unique()
+        assert self.dc.numread == self.dg.numread == 16
+        assert self.dc.nshared == 1 and self.dc.nempty == 10
+        assert self.dc.cid2counter['1'].num == 5
         
     def test_read2features(self):
         iv = HTSeq.GenomicInterval('chr1', 1600, 1620, '+')
         assert sorted(self.dg.read2features((iv,))) == ['g1', 'g2']
         assert sorted(self.dc.read2features((iv,))) == ['g1', 'g2']
     
+    def test_tally_sweep(self):
+        expected = {}
+        for read in self.dg.iter_reads():
+            fsid = self.dg.read2fsid(read) or 0
+            expected[fsid] = expected.get(fsid, 0) + 1
+        assert self.dg.tally_sweep() == expected
+        assert self.dg.tally_sweep('chr1') == expected
+        blocks = [(iv.chrom, iv.strand, [(b.start, b.end) for b in read])
+            for read in self.dg.iter_reads() for iv in read[:1]]
+        assert list(self.dg.iter_blocks()) == blocks
+    
+    def test_tally_regions(self):
+        expected = self.dc.tally()
+        for mode in ('strict', 'end3'):
+            dr = DGE("data/read.bam", "data/gene.gtf", feature_type="exon", 
+                id_feature="gene_id", id_count="cluster_id", mode=mode, 
+                regions=True)
+            dr.chrom2regions = dr.annot.regions() # without merging gaps
+            hits = [hit for _, hit in dr.iter_hits()]
+            assert len(hits) == len(set(hit.query_name for hit in hits)) < 16
+            if mode == 'strict':
+                assert dr.tally() == expected
+            dr.count_unique(threads=2)
+            assert dr.numread == 16
+        dr.count_shared()
+        assert dr.nunique + dr.nshared + dr.nempty == 16
+    
+    def test_count_end3(self):
+        de = DGE("data/read.bam", "data/gene.gtf", feature_type="exon", 
+            id_feature="gene_id", id_count="gene_id", mode='end3')
+        expected = {}
+        for read, end in zip(self.dg.iter_reads(), de.iter_ends()):
+            iv = read[-1] if read[0].strand == '+' else read[0]
+            pos = iv.end - 1 if iv.strand == '+' else iv.start
+            assert end == (iv.chrom, iv.strand, pos)
+            fsid = de.annot.lookup(iv.chrom, iv.strand, pos, pos + 1)
+            expected[fsid] = expected.get(fsid, 0) + 1
+        assert de.tally() == de.tally_ends(batchsize=3) == expected
+        de.count_unique(threads=2)
+        assert de.numread == 16
+        assert de.nunique + de.nshared + de.nempty == 16
+    
+class DGECache_Test(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.gtf = os.path.join(self.tmpdir, 'gene.gtf')
+        shutil.copy("data/gene.gtf", self.gtf)
+        
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        
+    def count(self, id_count='cluster_id'):
+        dge = DGE("data/read.bam", self.gtf, feature_type="exon", 
+            id_feature="gene_id", id_count=id_count, cache=True)
+        dge.count_unique()
+        dge.count_shared()
+        return dge
+        
+    def test_cache(self):
+        built = self.count()
+        cachedir = built.cache_dir()
+        assert os.listdir(self.tmpdir) == ['gene.gtf', 
+            os.path.basename(cachedir)]
+        loaded = self.count()
+        assert loaded.fid2cid == built.fid2cid
+        assert loaded.cid2length == built.cid2length == {'1':400, '2':300}
+        assert loaded.cid2counter['1'].num == built.cid2counter['1'].num == 5
+        self.count('gene_id')
+        assert len(os.listdir(self.tmpdir)) == 3
+        with open(self.gtf, 'a') as oh:
+            oh.write('\n')
+        assert self.count().cache_dir() != cachedir
+        
+def write_bam(filename, chroms, reads):
+    """Write indexed BAM of reads (chrom index, cigar, start, flag, mapq)"""
+    oh = pysam.AlignmentFile(filename, 'wb', 
+        header={'SQ':[{'SN':chrom, 'LN':10000} for chrom in chroms]})
+    for i, (tid, cigar, start, flag, mapq) in enumerate(reads):
+        hit = pysam.AlignedSegment()
+        hit.query_name = 'r%d' % i
+        hit.flag = flag
+        hit.reference_id = tid
+        hit.reference_start = start
+        hit.mapping_quality = mapq
+        hit.cigarstring = cigar
+        hit.query_sequence = 'A' * hit.infer_query_length()
+        oh.write(hit)
+    oh.close()
+    pysam.index(filename)
+
+class DGECross_Test(unittest.TestCase):
+    """Reads crossing steps, of sets made only by intersection of steps"""
+    # exons a[0,100), b[0,200), c[50,200) on chr1 and d, e, f on chr2
+    gtf = [(chrom, start, end, gid) for chrom, gids in 
+        (('chr1', 'abc'), ('chr2', 'def')) for (start, end), gid in 
+        zip([(1, 100), (1, 200), (51, 200)], gids)]
+    reads = [(0, '20M', 10, 0, 60), # a, b
+        (0, '71M', 39, 0, 60), # b
+        (0, '71M', 40, 0, 60), # b
+        (0, '20M', 150, 0, 60), # b, c
+        (1, '30M', 20, 0, 60), # d, e
+        (1, '71M', 39, 0, 60), # e
+        (1, '20M', 60, 0, 60)] # d, e, f
+    
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.gtf_file = os.path.join(self.tmpdir, 'gene.gtf')
+        with open(self.gtf_file, 'w') as oh:
+            for chrom, start, end, gid in self.gtf:
+                oh.write('%s\tt\texon\t%d\t%d\t0\t+\t.\tgene_id "%s";\n' % (
+                    chrom, start, end, gid))
+        self.bam = os.path.join(self.tmpdir, 'read.bam')
+        write_bam(self.bam, ['chr1', 'chr2'], self.reads)
+        
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        
+    def dge(self, bam=None):
+        return DGE(bam or self.bam, self.gtf_file, feature_type="exon", 
+            id_feature="gene_id", id_count="gene_id")
+        
+    def counts(self, dge):
+        return ((dge.numread, dge.nunique, dge.nshared, dge.nempty),
+            dict((cid, (c.unique, round(c.shared, 6)))
+                for cid, c in dge.cid2counter.items()))
+        
+    def test_count_parallel(self):
+        serial = self.dge()
+        serial.count_unique()
+        serial.count_shared()
+        assert serial.cid2counter['b'].unique == 2
+        assert serial.cid2counter['e'].unique == 1
+        parallel = self.dge()
+        parallel.count_unique(threads=2)
+        parallel.count_shared()
+        assert self.counts(parallel) == self.counts(serial)
+        
+    def test_matrix_parallel(self):
+        bam2 = os.path.join(self.tmpdir, 'read2.bam')
+        write_bam(bam2, ['chr1', 'chr2'], self.reads[1:])
+        serial = DGEMatrix([self.bam, bam2], self.gtf_file, 
+            feature_type="exon", id_feature="gene_id", id_count="gene_id")
+        serial.count()
+        parallel = DGEMatrix([self.bam, bam2], self.gtf_file, 
+            feature_type="exon", id_feature="gene_id", id_count="gene_id")
+        parallel.count(threads=2)
+        for dge, expected in zip(parallel.dges, serial.dges):
+            assert self.counts(dge) == self.counts(expected)
+        
+class DGEFilter_Test(unittest.TestCase):
+    # (cigar, start, flag, mapq) of reads on exons of gene.gtf
+    reads = [('3S20M2I10M2D10M5S', 1610, 0, 60), # g1, g2
+        ('10M100N10M', 1690, 0, 60), # g1, g2
+        ('20=5X', 2010, 0, 60), # g1
+        ('25M', 2310, FLAG_SECONDARY | 16, 60), # none on - strand
+        ('25M', 2310, 0, 5), # g2
+        ('10H25M', 2320, FLAG_SUPPLEMENTARY, 60), # g2
+        ('25M', 2330, 4, 0)]
+        
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.bam = os.path.join(self.tmpdir, 'read.bam')
+        write_bam(self.bam, ['chr1'], [(0, ) + read for read in self.reads])
+        
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        
+    def dge(self, **options):
+        return DGE(self.bam, "data/gene.gtf", feature_type="exon", 
+            id_feature="gene_id", id_count="gene_id", **options)
+        
+    def test_blocks(self):
+        blocks = [b for _, _, b in self.dge().iter_blocks()]
+        assert blocks[0] == [(1610, 1630), (1630, 1640), (1642, 1652)]
+        assert blocks[1] == [(1690, 1700), (1800, 1810)]
+        assert blocks[2] == [(2010, 2030), (2030, 2035)]
+        assert len(blocks) == 6
+        ends = list(self.dge().iter_ends())
+        assert ends[:4] == [('chr1', '+', 1651), ('chr1', '+', 1809),
+            ('chr1', '+', 2034), ('chr1', '-', 2310)]
+        
+    def test_count(self):
+        dge = self.dge()
+        dge.count_unique()
+        assert dge.numread == 6 and dge.nshared == 2 and dge.nempty == 1
+        assert dge.cid2counter['g1'].unique == 1
+        assert dge.cid2counter['g2'].unique == 2
+        dge = self.dge(min_mapq=10, 
+            exclude_flags=FLAG_SECONDARY | FLAG_SUPPLEMENTARY)
+        dge.count_unique()
+        assert dge.numread == 3 and dge.nshared == 2
+        assert dge.cid2counter['g2'].unique == 0
+        dge = self.dge(mode='end3', min_mapq=10)
+        dge.count_unique()
+        assert dge.numread == 5 and dge.nunique == 2 and dge.nshared == 2
+        
+class DGEMatrix_Test(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dm = DGEMatrix(["data/read.bam"] * 3, "data/gene.gtf", 
+            feature_type="exon", id_feature="gene_id", id_count="cluster_id",
+            names=['s1', 's2', 's3'])
+        
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        
+    def test_shared(self):
+        dges = self.dm.dges
+        assert dges[1].annot is dges[0].annot
+        assert dges[1].cid2counter is not dges[0].cid2counter
+        
+    def test_names(self):
+        options = dict(gtf_file="data/gene.gtf", feature_type="exon", 
+            id_feature="gene_id", id_count="cluster_id")
+        bams = [os.path.join(self.tmpdir, d, 's1.bam') for d in 'ab']
+        for bam in bams:
+            os.mkdir(os.path.dirname(bam))
+            shutil.copy("data/read.bam", bam)
+        dm = DGEMatrix(bams[:1] + ["data/read.bam"], **options)
+        assert dm.names == ['s1', 'read']
+        dm = DGEMatrix(bams, **options)
+        assert dm.names == [bam[:-4] for bam in bams]
+        self.assertRaises(AssertionError, DGEMatrix, ["data/read.bam"] * 2, 
+            **options)
+        self.assertRaises(AssertionError, DGEMatrix, bams, names=['s', 's'], 
+            **options)
+        
+    def test_write(self):
+        self.dm.count(threads=2)
+        outprefix = os.path.join(self.tmpdir, 'exp')
+        self.dm.write(outprefix)
+        lines = open(outprefix + '.unique').read().splitlines()
+        assert lines[1:] == ['#read\t\t16\t16\t16', 
+            'id\tlength\ts1\ts2\ts3', '1\t400\t4\t4\t4', '2\t300\t1\t1\t1']
+        lines = open(outprefix + '.shared').read().splitlines()
+        assert lines[3] == '1\t400\t1.0000\t1.0000\t1.0000'
+        lines = open(outprefix + '.rpkm').read().splitlines()
+        assert lines[3].split('\t')[2] == '781250.0000'
+    
 ###############################################################################
 
 if __name__ == '__main__':
@@ -0,0 +1,398 @@
+#!/usr/bin/env python
+
+import os
+import gzip
+import random
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+from maps.io_utils.fastq import (reader_fastq, split_fastq, parse_fastq_blocks,
+    index_fastq, load_index, reader_fastq_records, sample_fastq, filter_fastq,
+    filter_block, iter_record_blocks, dropend_fastq)
+from maps.io_utils import fastq
+from maps.io_utils.bgzf import BgzfWriter, GzipReader, copy_compressed
+
+###############################################################################
+
+def random_fastq(num, seed=0, length=50):
+    """Return fastq text of num random records, quality may start with '@'"""
+    rnd = random.Random(seed)
+    lines = []
+    for i in xrange(num):
+        seqlen = rnd.randint(length // 2, length)
+        lines.append('@r%d' % (i+1))
+        lines.append(''.join(rnd.choice('ACGTN') for _ in xrange(seqlen)))
+        lines.append('+r%d' % (i+1))
+        lines.append(''.join(rnd.choice('@+ABCDEFGHIJ') for _ in xrange(seqlen)))
+    return '\n'.join(lines) + '\n'
+
+###############################################################################
+
+class Reader_Test(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.infile = os.path.join(self.tmpdir, 'reads.fastq')
+        with open(self.infile, 'w') as oh:
+            oh.write(random_fastq(500))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_reader_fastq(self):
+        fqs = [fq for fq in reader_fastq(self.infile)]
+        assert len(fqs) == 500
+        assert fqs[0].get_name() == 'r1'
+        assert fqs[-1].get_name() == 'r500'
+
+    def test_split_fastq(self):
+        names = [fq.get_name() for fq in reader_fastq(self.infile)]
+        for nchunk in (1, 2, 7, 64):
+            chunks = split_fastq(self.infile, nchunk)
+            assert len(chunks) <= nchunk
+            assert chunks[0][0] == 0
+            assert chunks[-1][1] == os.path.getsize(self.infile)
+            obs = [fq.get_name() for (s, e) in chunks
+                for fq in reader_fastq(self.infile, s, e)]
+            assert obs == names
+
+    def test_parse_blocks(self):
+        text = open(self.infile).read()
+        names = [fq.get_name() for fq in reader_fastq(self.infile)]
+        for size in (1, 7, 1000):
+            chunks = [text[i:i+size] for i in xrange(0, len(text), size)]
+            fqs = list(parse_fastq_blocks(chunks))
+            assert [fq.get_name() for fq in fqs] == names
+            assert ''.join(fq.as_raw() for fq in fqs) == text
+        fqs = list(parse_fastq_blocks(['@r1\r\nACG\r\n+\r', 
+            '\nIII\r\n@r2\nAC\n+\nII']))
+        assert [(fq.name, fq.seq, fq.qual) for fq in fqs] == [
+            ('r1', 'ACG', 'III'), ('r2', 'AC', 'II')]
+        self.assertRaises(ValueError, list, parse_fastq_blocks(['r1\nA\n+\nI\n']))
+
+    def test_as_raw(self):
+        fqs = list(reader_fastq(self.infile, 0, os.path.getsize(self.infile)))
+        assert ''.join(fq.as_raw() for fq in fqs) == open(self.infile).read()
+        fq = next(parse_fastq_blocks(['@r1 x\nACGTN\n+\nIIII#\n']))
+        assert fq.as_raw() == '@r1 x\nACGTN\n+\nIIII#\n'
+        fq.remove_tail_N()
+        assert fq.as_raw() == '@r1 x\nACGT\n+\nIIII\n'
+        fq.clean_name()
+        assert fq.as_raw() == '@r1\nACGT\n+r1\nIIII\n'
+        assert not hasattr(fq, '__dict__')
+
+###############################################################################
+
+class Bgzf_Test(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.text = random_fastq(3000)
+        self.infile = os.path.join(self.tmpdir, 'reads.fastq')
+        with open(self.infile, 'w') as oh:
+            oh.write(self.text)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_writer(self):
+        outfile = os.path.join(self.tmpdir, 'reads.fastq.gz')
+        oh = BgzfWriter(outfile)
+        for line in self.text.splitlines(True):
+            oh.write(line)
+        oh.close()
+        assert gzip.open(outfile).read() == self.text
+        assert ''.join(GzipReader(outfile)) == self.text
+        names = [fq.get_name() for fq in reader_fastq(outfile)]
+        assert names == [fq.get_name() for fq in reader_fastq(self.infile)]
+        assert split_fastq(outfile, 4) == [(0, None)]
+
+    def test_reader_stop(self):
+        outfile = os.path.join(self.tmpdir, 'reads.fastq.gz')
+        oh = BgzfWriter(outfile)
+        oh.write(random_fastq(30000))
+        oh.close()
+        nthread = threading.active_count()
+        records = reader_fastq(outfile)
+        assert next(records).get_name()
+        records.close()
+        for _ in xrange(50):
+            if threading.active_count() == nthread:
+                break
+            time.sleep(0.02)
+        assert threading.active_count() == nthread
+
+    def test_reader_members(self):
+        outfile = os.path.join(self.tmpdir, 'reads.gz')
+        half = len(self.text) // 2
+        for part in (self.text[:half], self.text[half:]):
+            oh = gzip.open(outfile, 'ab')
+            oh.write(part)
+            oh.close()
+        assert ''.join(GzipReader(outfile)) == self.text
+
+    def test_copy_compressed(self):
+        parts = []
+        for i, part in enumerate((self.text[:1000], self.text[1000:])):
+            parts.append(os.path.join(self.tmpdir, 'part%d.gz' % i))
+            oh = BgzfWriter(parts[-1])
+            oh.write(part)
+            oh.close()
+        outfile = os.path.join(self.tmpdir, 'reads.gz')
+        oh = BgzfWriter(outfile)
+        for part in parts:
+            copy_compressed(part, oh)
+        oh.close()
+        assert gzip.open(outfile).read() == self.text
+        assert os.path.getsize(outfile) == sum(
+            os.path.getsize(f) for f in parts) - 28
+
+###############################################################################
+
+class Index_Test(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.text = random_fastq(3000)
+        self.names = ['r%d' % (i+1) for i in xrange(3000)]
+        self.infile = os.path.join(self.tmpdir, 'reads.fastq')
+        with open(self.infile, 'w') as oh:
+            oh.write(self.text)
+        self.gzfile = os.path.join(self.tmpdir, 'reads.fastq.gz')
+        oh = BgzfWriter(self.gzfile)
+        oh.write(self.text)
+        oh.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_index(self):
+        for infile in (self.infile, self.gzfile):
+            index = index_fastq(infile, step=7)
+            assert index.nrecord == 3000
+            assert len(index.offsets) == 429
+            for i in (0, 1, 100, 428):
+                fq = next(reader_fastq(infile, index.offsets[i]))
+                assert fq.get_name() == self.names[i * 7]
+            loaded = load_index(infile)
+            assert loaded.offsets == index.offsets
+            assert loaded.bgzf == (infile == self.gzfile)
+
+    def test_records(self):
+        for infile in (self.infile, self.gzfile):
+            assert load_index(infile) is None
+            index = index_fastq(infile, step=100)
+            for start, end in ((0, 10), (99, 201), (2950, None), (2999, 3000)):
+                obs = [fq.get_name() for fq in 
+                    reader_fastq_records(infile, start, end)]
+                assert obs == self.names[start:end]
+            assert list(reader_fastq_records(infile, 3000)) == []
+            assert list(reader_fastq_records(infile, 3500, 3600)) == []
+            os.unlink(infile + '.fqi')
+            obs = [fq.get_name() for fq in reader_fastq_records(infile, 5, 8)]
+            assert obs == self.names[5:8]
+            assert list(reader_fastq_records(infile, 3500, 3600)) == []
+
+    def test_index_edge(self):
+        empty = os.path.join(self.tmpdir, 'empty.fastq')
+        open(empty, 'w').close()
+        index = index_fastq(empty)
+        assert index.nrecord == 0 and index.offsets == []
+        assert index.split(4) == [(0, None)]
+        assert list(reader_fastq_records(empty, 0, 10)) == []
+        infile = os.path.join(self.tmpdir, 'nonewline.fastq')
+        with open(infile, 'w') as oh:
+            oh.write(self.text[:-1])
+        index = index_fastq(infile, step=1)
+        assert index.nrecord == 3000 and len(index.offsets) == 3000
+        fq = next(reader_fastq_records(infile, 2999))
+        assert fq.get_name() == self.names[2999]
+
+    def test_split(self):
+        for infile in (self.infile, self.gzfile):
+            index_fastq(infile, step=50)
+            chunks = split_fastq(infile, 4)
+            assert len(chunks) == 4 and chunks[-1][1] is None
+            obs = [fq.get_name() for (s, e) in chunks
+                for fq in reader_fastq(infile, s, e)]
+            assert obs == self.names
+        with open(self.infile, 'a') as oh:
+            oh.write('@r3001\nA\n+\nI\n')
+        assert load_index(self.infile) is None
+
+###############################################################################
+
+def filter_records(text, minlen=6, filterN=False, trimN=False):
+    """Filter records one by one, as reference of filter_block"""
+    out = []
+    for fq in parse_fastq_blocks([text]):
+        if trimN:
+            fq.remove_tail_N()
+        lenseq = fq.get_length()
+        if lenseq != len(fq.get_qual()) or lenseq < minlen:
+            continue
+        if filterN and fq.get_num_N() > (
+                0 if lenseq <= 10 else 1 if lenseq <= 20 else 2):
+            continue
+        out.append(fq.as_raw())
+    return ''.join(out)
+
+class Filter_Test(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.text = random_fastq(2000, length=40)
+        self.infile = os.path.join(self.tmpdir, 'reads.fastq')
+        with open(self.infile, 'w') as oh:
+            oh.write(self.text)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_remove_tail_N(self):
+        fq = next(parse_fastq_blocks(['@r1\nANCNN\n+\nIIIII\n']))
+        fq.remove_tail_N()
+        assert (fq.seq, fq.qual) == ('ANC', 'III')
+        fq = next(parse_fastq_blocks(['@r1\nNN\n+\nII\n']))
+        fq.remove_tail_N()
+        assert (fq.seq, fq.qual) == ('', '')
+
+    def test_filter_block(self):
+        text = self.text + '@x\nNNNN\n+\nIIII\n@y\nACGT\n+\nIII\n'
+        for minlen in (0, 6, 30):
+            for filterN in (False, True):
+                for trimN in (False, True):
+                    expected = filter_records(text, minlen, filterN, trimN)
+                    obs = filter_block(text, minlen, filterN, trimN)
+                    assert obs[0] == expected
+                    assert obs[1:] == (2002, expected.count('\n') // 4)
+        assert filter_block(self.text, 0)[0] == self.text
+
+    def test_record_blocks(self):
+        for size in (1, 50, 999):
+            chunks = [self.text[i:i+size] for i in xrange(0, len(self.text), size)]
+            blocks = list(iter_record_blocks(chunks))
+            assert ''.join(blocks) == self.text
+            assert all(block.count('\n') % 4 == 0 for block in blocks)
+        assert list(iter_record_blocks(['@r1\nA\n+\nI'])) == ['@r1\nA\n+\nI']
+
+    def test_filter_fastq(self):
+        expected = filter_records(self.text, 10, True, True)
+        blocksize = fastq.BLOCK_SIZE
+        fastq.BLOCK_SIZE = 5000
+        try:
+            for threads in (1, 3):
+                outfile = os.path.join(self.tmpdir, 'out%d.fastq.gz' % threads)
+                nread, nkept = filter_fastq(self.infile, outfile, minlen=10, 
+                    filterN=True, trimN=True, threads=threads)
+                assert nread == 2000
+                assert gzip.open(outfile).read() == expected
+                assert nkept == expected.count('\n') // 4
+        finally:
+            fastq.BLOCK_SIZE = blocksize
+
+class Dropend_Test(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.text = random_fastq(2000, length=40)
+        self.infile = os.path.join(self.tmpdir, 'reads.fastq')
+        with open(self.infile, 'w') as oh:
+            oh.write(self.text)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_dropend(self):
+        expected = []
+        for fq in reader_fastq(self.infile):
+            fq.trim(3, fq.get_length() - 5)
+            if fq.get_length() >= 15:
+                expected.append(fq.as_raw())
+        expected = ''.join(expected)
+        blocksize = fastq.BLOCK_SIZE
+        fastq.BLOCK_SIZE = 5000
+        try:
+            for threads in (1, 3):
+                outfile = os.path.join(self.tmpdir, 'out%d.fastq.gz' % threads)
+                nread, nshort = dropend_fastq(self.infile, outfile, drop5=3, 
+                    drop3=5, minlen=15, threads=threads)
+                assert gzip.open(outfile).read() == expected
+                assert nread - nshort == expected.count('\n') // 4
+        finally:
+            fastq.BLOCK_SIZE = blocksize
+
+    def test_dropend_all(self):
+        outfile = os.path.join(self.tmpdir, 'out.fastq')
+        assert dropend_fastq(self.infile, outfile, drop3=40) == (2000, 0)
+        fqs = list(reader_fastq(outfile))
+        assert len(fqs) == 2000 and fqs[0].get_seq() == ''
+
+###############################################################################
+
+class Sample_Test(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.text = random_fastq(3000)
+        self.names = ['r%d' % (i+1) for i in xrange(3000)]
+        self.infile = os.path.join(self.tmpdir, 'reads.fastq')
+        with open(self.infile, 'w') as oh:
+            oh.write(self.text)
+        self.gzfile = os.path.join(self.tmpdir, 'reads.fastq.gz')
+        oh = BgzfWriter(self.gzfile)
+        oh.write(self.text)
+        oh.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def sample(self, infile, **kwargs):
+        return [fq.get_name() for fq in sample_fastq(infile, **kwargs)]
+
+    def check(self, names):
+        """sampled names are distinct and in file order"""
+        idx = [self.names.index(name) for name in names]
+        assert idx == sorted(set(idx))
+
+    def test_stream(self):
+        names = self.sample(self.gzfile, count=100, seed=1)
+        assert len(names) == 100
+        self.check(names)
+        assert names == self.sample(self.gzfile, count=100, seed=1)
+        assert names != self.sample(self.gzfile, count=100, seed=2)
+        assert self.sample(self.gzfile, count=5000) == self.names
+        names = self.sample(self.gzfile, fraction=0.1)
+        assert 200 < len(names) < 400
+        self.check(names)
+
+    def test_indexed(self):
+        for infile in (self.infile, self.gzfile):
+            index_fastq(infile, step=100)
+            names = self.sample(infile, count=250, seed=3)
+            assert len(names) == 250
+            self.check(names)
+            assert len(self.sample(infile, fraction=0.01)) == 30
+            assert self.sample(infile, count=5000) == self.names
+
+    def test_offset(self):
+        for seed in xrange(5):
+            names = self.sample(self.infile, count=100, seed=seed)
+            assert len(names) == 100
+            self.check(names)
+        # fewer records than drawn, sampled from stream
+        names = [fq.get_name() for fq in fastq.sample_by_offset(self.infile,
+            5000, random.Random(0))]
+        assert names == self.names
+        # many records sampled from stream
+        assert len(self.sample(self.infile, count=1000)) == 1000
+
+    def test_filter_dry_run(self):
+        outfile = os.path.join(self.tmpdir, 'out.fastq')
+        nread, nkept = filter_fastq(self.infile, outfile, minlen=40, 
+            dry_run=100)
+        assert not os.path.exists(outfile)
+        assert nread >= 90 and 0 < nkept < nread
+        assert filter_fastq(self.infile, outfile, minlen=40)[0] == 3000
+
+###############################################################################
+
+if __name__ == '__main__':
+    unittest.main(testRunner=unittest.TextTestRunner(verbosity=2))
+
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import unittest
+import HTSeq
+from maps.io_utils.gtf import parse_attrs, reader_gtf
+from maps.io_utils.bgzf import BgzfWriter
+
+###############################################################################
+
+class GTF_Test(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_parse_attrs(self):
+        text = 'gene_id "g1"; transcript_id "1_1"; cluster_id 1;'
+        assert parse_attrs(text, ['cluster_id', 'gene_id']) == ('1', 'g1')
+        assert parse_attrs(text, ['gene_name']) == (None, )
+        assert parse_attrs('', ['gene_id']) == (None, )
+        assert parse_attrs(text, ['gene_id', 'gene_id']) == ('g1', 'g1')
+
+    def test_reader(self):
+        expected = [(f.iv.chrom, f.type, f.iv.start, f.iv.end, f.iv.strand,
+            (f.attr['gene_id'], f.attr['cluster_id']))
+            for f in HTSeq.GFF_Reader('data/gene.gtf')]
+        obs = list(reader_gtf('data/gene.gtf', ('gene_id', 'cluster_id')))
+        assert obs == expected
+        obs = list(reader_gtf('data/gene.gtf', feature_type='CDS'))
+        assert obs == []
+
+    def test_reader_missing(self):
+        gtf = os.path.join(self.tmpdir, 'gene.gtf')
+        with open(gtf, 'w') as oh:
+            oh.write('c\tt\tgene\t1\t9\t0\t+\t.\tgene_id "g1";\n')
+            oh.write('c\tt\texon\t1\t5\t0\t+\t.\tgene_id "g1";\n')
+        obs = list(reader_gtf(gtf, ('gene_id', 'cluster_id')))
+        assert [r[-1] for r in obs] == [('g1', None), ('g1', None)]
+        assert list(reader_gtf(gtf, ('gene_id', ), required='exon'))
+        try:
+            list(reader_gtf(gtf, ('gene_id', 'cluster_id'), 'exon'))
+            assert False, 'missing attribute not raised'
+        except ValueError, err:
+            assert 'cluster_id at line 2' in str(err)
+        self.assertRaises(ValueError, list, reader_gtf(gtf, 
+            ('cluster_id', ), required='gene'))
+
+    def test_reader_gzip(self):
+        gzfile = os.path.join(self.tmpdir, 'gene.gtf.gz')
+        oh = BgzfWriter(gzfile)
+        oh.write('#comment\n' + open('data/gene.gtf').read())
+        oh.close()
+        assert list(reader_gtf(gzfile, ('gene_id', ))) == list(
+            reader_gtf('data/gene.gtf', ('gene_id', )))
+
+###############################################################################
+
+if __name__ == '__main__':
+    unittest.main(testRunner=unittest.TextTestRunner(verbosity=2))
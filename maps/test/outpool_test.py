@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+import os
+import gzip
+import shutil
+import tempfile
+import unittest
+from maps.io_utils.outpool import OutputPool
+
+###############################################################################
+
+class OutputPool_Test(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def check_pool(self, suffix, fopen):
+        pool = OutputPool(max_open=3, bufsize=100)
+        keys = range(10)
+        for k in keys:
+            pool.add(k, os.path.join(self.tmpdir, '%d%s' % (k, suffix)))
+        for i in xrange(2000):
+            pool.write(i % 7, '%d\n' % i)
+            assert len(pool.handles) <= 3
+        pool.close()
+        for k in keys:
+            expected = ''.join('%d\n' % i for i in xrange(2000) if i % 7 == k)
+            assert fopen(pool.get_file(k)).read() == expected
+
+    def test_plain(self):
+        self.check_pool('', open)
+
+    def test_bgzf(self):
+        self.check_pool('.gz', gzip.open)
+
+    def test_truncate(self):
+        outfile = os.path.join(self.tmpdir, 'a')
+        with open(outfile, 'w') as oh:
+            oh.write('old')
+        pool = OutputPool()
+        pool.add('a', outfile)
+        pool.write('a', 'new')
+        pool.close()
+        assert open(outfile).read() == 'new'
+
+###############################################################################
+
+if __name__ == '__main__':
+    unittest.main(testRunner=unittest.TextTestRunner(verbosity=2))
+
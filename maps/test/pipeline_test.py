@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from maps.barcode import DecodeStats, DecoderHash
+from maps.io_utils.fastq import Fastq, reader_fastq
+from maps.pipeline import DropEnd, TrimTail, MinLength, make_stages
+from maps.io_utils.trimmer import Trimmer
+from fastq_test import random_fastq
+
+###############################################################################
+
+def run_stage(stage, seqs, bc='b1'):
+    stats = DecodeStats()
+    items = [(bc, Fastq('r%d' % i, seq, 'I' * len(seq))) 
+        for i, seq in enumerate(seqs)]
+    return [r.get_seq() for b, r in stage(items, stats)], stats
+
+class Stage_Test(unittest.TestCase):
+    def test_dropend(self):
+        assert run_stage(DropEnd(2, 3), ['ACGTACGT', 'ACG'])[0] == ['GTA', '']
+        assert run_stage(DropEnd(0, 3), ['ACGTACGT'])[0] == ['ACGTA']
+        assert run_stage(DropEnd(2, 0), ['ACGTACGT'])[0] == ['GTACGT']
+
+    def test_trimtail(self):
+        stage = TrimTail(Trimmer('TGGAATTC', min_polya=4))
+        obs, stats = run_stage(stage, ['CCCCAAAAAATGGAATTCGG', 'CCCCAAATGG',
+            'CCCCAAAAAAAA', 'CCCCTG', 'CCCC'])
+        assert obs == ['CCCC', 'CCCCAAA', 'CCCC', 'CCCCTG', 'CCCC']
+        assert dict(stats.hists['trimmed']) == {16:1, 3:1, 8:1}
+        assert dict(stats.hists['trimmed_adapter']) == {10:1, 3:1}
+        assert dict(stats.hists['trimmed_polya']) == {6:1, 8:1}
+
+    def test_minlength(self):
+        obs, stats = run_stage(MinLength(4), ['ACGT', 'ACG', 'A'])
+        assert obs == ['ACGT']
+        assert stats.counters['short'] == 2
+
+    def test_failed(self):
+        stage = MinLength(4)
+        assert run_stage(stage, ['ACG'], bc='failed')[0] == ['ACG']
+
+    def test_make_stages(self):
+        assert make_stages() == []
+        stages = make_stages(drop3=2, min_polya=5, minlen=18)
+        assert [s.__class__ for s in stages] == [DropEnd, TrimTail, MinLength]
+
+###############################################################################
+
+class DecoderPipeline_Test(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.infile = os.path.join(self.tmpdir, 'lane.fastq')
+        with open(self.infile, 'w') as oh:
+            oh.write(random_fastq(2000, length=40))
+        self.barcode2name = {'ACGT':'s1', 'TTTT':'s2'}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_decode(self):
+        serial = os.path.join(self.tmpdir, 'serial')
+        parallel = os.path.join(self.tmpdir, 'parallel')
+        for outprefix, threads in ((serial, 1), (parallel, 3)):
+            dc = DecoderHash(self.infile, self.barcode2name, mismatch=1, 
+                startpos=1, outprefix=outprefix, 
+                stages=make_stages(drop5=6, min_polya=1, minlen=20))
+            dc.decode(threads=threads)
+        for name in ('s1', 's2', 'failed'):
+            obs = open('%s.%s.m1' % (parallel, name)).read()
+            assert obs == open('%s.%s.m1' % (serial, name)).read()
+        
+        stats = json.load(open(serial+'.decode.json'))
+        assert stats == dict(json.load(open(parallel+'.decode.json')), 
+            seconds=stats['seconds'], reads_per_sec=stats['reads_per_sec'])
+        nreads = 0
+        for name in ('s1', 's2'):
+            for fq in reader_fastq('%s.%s.m1' % (serial, name)):
+                nreads += 1
+                assert fq.get_length() >= 20
+                assert not fq.get_seq().endswith('A')
+        decoded = sum(s['reads'] for s in stats['samples'].values())
+        assert nreads == decoded - stats['counters']['short']
+
+###############################################################################
+
+if __name__ == '__main__':
+    unittest.main(testRunner=unittest.TextTestRunner(verbosity=2))
+
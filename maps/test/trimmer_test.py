@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import unittest
+from maps.io_utils.fastq import Fastq, reader_fastq
+from maps.io_utils.trimmer import Trimmer, trim_fastq
+
+###############################################################################
+
+adapter = 'TGGAATTCTCGG'
+
+class Trimmer_Test(unittest.TestCase):
+    def setUp(self):
+        self.tr = Trimmer(adapter, error_rate=0.1, min_polya=5)
+
+    def test_find_adapter(self):
+        tr = self.tr
+        assert tr.find_adapter('CCCCC' + adapter + 'AAA') == 5
+        assert tr.find_adapter('CCCCC' + 'TGGAATTCTAGG') == 5 # 1 mismatch
+        assert tr.find_adapter('CCCCC' + 'TGGTATTCTAGG') is None # 2 mismatches
+        assert tr.find_adapter('CCCCC' + 'TGCAATTCTCGG') == 5 # mismatch in seed
+        assert tr.find_adapter('CCCCC' + adapter[:7]) == 5
+        assert tr.find_adapter('CCCCC' + adapter[:3]) == 5
+        assert tr.find_adapter('CCCCC' + adapter[:2]) is None
+        assert tr.find_adapter('CCCCCCCC') is None
+
+    def test_find_polya(self):
+        tr = self.tr
+        assert tr.find_polya('CCCCAAAAA', 9) == 4
+        assert tr.find_polya('CCCCAAAA', 8) == 8 # shorter than min_polya
+        assert tr.find_polya('CCCCAAAAGAAAA', 13) == 4
+        assert tr.find_polya('CCCCAAAAAC', 10) == 10
+        assert tr.find_polya('CCCCAAAAACC', 9) == 4
+
+    def test_find_quality(self):
+        tr = Trimmer(qual_cutoff=20)
+        assert tr.find_quality('IIIIIIII', 8) == 8
+        assert tr.find_quality('IIIIII##', 8) == 6
+        assert tr.find_quality('IIII#I##', 8) == 6
+        assert tr.find_quality('IIII##I##', 9) == 4
+
+    def test_trim(self):
+        tr = Trimmer(adapter, min_polya=5, qual_cutoff=20)
+        fq = Fastq('r1', 'CCCCAAAAAA' + adapter + 'CC', 'I' * 22 + '##')
+        assert tr.trim(fq) == (2, 12, 6)
+        assert fq.get_seq() == 'CCCC'
+        assert fq.get_qual() == 'IIII'
+
+    def test_trim_fastq(self):
+        tmpdir = tempfile.mkdtemp()
+        infile = os.path.join(tmpdir, 'in.fastq')
+        outfile = os.path.join(tmpdir, 'out.fastq')
+        with open(infile, 'w') as oh:
+            for i, seq in enumerate(['CCCCCCAAAAAA' + adapter, 'CCCCCCCCCCCC', 
+                    'CCCAAAAA']):
+                oh.write(str(Fastq('r%d' % i, seq, 'I' * len(seq))) + '\n')
+        hists, nshort = trim_fastq(infile, outfile, self.tr, minlen=6)
+        assert [fq.get_seq() for fq in reader_fastq(outfile)] == [
+            'CCCCCC', 'CCCCCCCCCCCC']
+        assert nshort == 1
+        assert hists['trimmed'] == {18:1, 5:1}
+        assert hists['trimmed_adapter'] == {12:1}
+        shutil.rmtree(tmpdir)
+
+###############################################################################
+
+if __name__ == '__main__':
+    unittest.main(testRunner=unittest.TextTestRunner(verbosity=2))
+
@@ -72,6 +72,46 @@ class TestGeneratorBed(unittest.TestCase):
         
 ############################################################################### 
 
+class TestTopKSketch(unittest.TestCase):
+    """Test TopKSketch class"""
+    def setUp(self):
+        self.items = ['a'] * 50 + ['b'] * 30 + list('cdefghijklmnopqrstuvwxyz')
+    
+    def test_exact(self):
+        sk = TopKSketch(100)
+        for item in self.items:
+            sk.add(item)
+        assert sk.top(3) == [('a', 50), ('b', 30), ('c', 1)]
+    
+    def test_bounded(self):
+        sk = TopKSketch(5)
+        for item in self.items:
+            sk.add(item)
+        assert len(sk.item2count) <= 5
+        top = sk.top(2)
+        assert [item for item, cnt in top] == ['a', 'b']
+        assert top[0][1] >= 50 - len(self.items) // 6
+        
+    def test_merge(self):
+        sk1 = TopKSketch(5)
+        sk2 = TopKSketch(5)
+        for i, item in enumerate(self.items):
+            [sk1, sk2][i % 2].add(item)
+        sk1.merge(sk2)
+        assert len(sk1.item2count) <= 5
+        assert [item for item, cnt in sk1.top(2)] == ['a', 'b']
+
+###############################################################################
+
+class TestMapOrdered(unittest.TestCase):
+
+    def test_order(self):
+        for threads in (1, 3):
+            obs = list(map_ordered(abs, xrange(-50, 50), threads))
+            assert obs == map(abs, xrange(-50, 50))
+
+############################################################################### 
+
 if __name__ == '__main__':        
     unittest.main(testRunner=unittest.TextTestRunner(verbosity=2))
     
\ No newline at end of file
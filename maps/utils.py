@@ -3,6 +3,9 @@ Utilities
 """
 import os
 import string   
+import multiprocessing
+from collections import deque
+from itertools import islice
 from StringIO import StringIO
 
 ###############################################################################
@@ -108,5 +111,80 @@ def string2file(s, filename):
     with open(filename, "w") as oh:
         for line in StringIO(s):
             oh.write(line)
-            
-            
\ No newline at end of file
+
+###############################################################################
+
+def iter_batches(iterable, size):
+    """Generator of lists of at most size items from iterable"""
+    it = iter(iterable)
+    while True:
+        batch = list(islice(it, size))
+        if not batch:
+            break
+        yield batch
+
+###############################################################################
+
+def map_ordered(func, tasks, threads=1):
+    """
+    Generator of func(task) in order of tasks, computed by threads worker
+    processes with at most 2 * threads tasks pending
+    """
+    if threads <= 1:
+        for task in tasks:
+            yield func(task)
+        return
+    pool = multiprocessing.Pool(threads)
+    pending = deque()
+    try:
+        for task in tasks:
+            pending.append(pool.apply_async(func, (task, )))
+            if len(pending) >= 2 * threads:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+###############################################################################
+
+class TopKSketch(object):
+    """
+    Frequent items in a stream with bounded memory (Misra-Gries summary):
+    at most capacity counters, a count is underestimated by at most 
+    n/(capacity+1) for n added items
+    """
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.item2count = {}
+    
+    def add(self, item, count=1):
+        """Add occurrences of item"""
+        if item in self.item2count:
+            self.item2count[item] += count
+        else:
+            self.item2count[item] = count
+            if len(self.item2count) > self.capacity:
+                self._prune()
+    
+    def _prune(self):
+        """Subtract the (capacity+1)-th largest count, drop non-positive"""
+        counts = sorted(self.item2count.itervalues(), reverse=True)
+        cut = counts[self.capacity]
+        self.item2count = dict((k, v - cut) 
+            for k, v in self.item2count.iteritems() if v > cut)
+    
+    def merge(self, other):
+        """Merge sketch of another stream"""
+        for item, count in other.item2count.iteritems():
+            self.item2count[item] = self.item2count.get(item, 0) + count
+        if len(self.item2count) > self.capacity:
+            self._prune()
+    
+    def top(self, k):
+        """Return list of (item, count) of k most frequent items"""
+        return sorted(self.item2count.iteritems(), 
+            key=lambda x: (-x[1], x[0]))[:k]
+
+###############################################################################
@@ -7,6 +7,7 @@ import os
 import sys
 import optparse
 from maps.barcode import read_barcode, create_decoder
+from maps.pipeline import make_stages
 
 ################################################################################
 
@@ -31,6 +32,59 @@ def process_command_line(argv):
     parser.add_option("-m", "--mismatch", dest="mismatch", default=0,
         help="allowed mismatch[0 default]", type="int")
 
+    parser.add_option("--method", dest="method", default="hash",
+        help="decoding with mismatch by hash table, numpy batch or scan "
+        "[hash default]", type="choice", choices=["hash", "numpy", "scan"])
+
+    parser.add_option("--segment", dest="segments", action="append",
+        help="barcode segment as 1-based start,length,mismatch, repeat for "
+        "combinatorial barcodes given as segments joined by '+' in "
+        "file_barcode, -s and -m are ignored", type="str")
+
+    parser.add_option("-t", "--threads", dest="threads", default=1,
+        help="number of worker processes[1 default]", type="int")
+
+    parser.add_option("--drop5", dest="drop5", default=0,
+        help="number of nt to drop at 5'-end of decoded reads[0 default]", 
+        type="int")
+
+    parser.add_option("--drop3", dest="drop3", default=0,
+        help="number of nt to drop at 3'-end of decoded reads[0 default]", 
+        type="int")
+
+    parser.add_option("--adapter", dest="adapter", 
+        help="3'-adaptor sequence to trim from decoded reads", type="str")
+
+    parser.add_option("--error_rate", dest="error_rate", default=0.1,
+        help="maximum mismatch rate in adaptor match[0.1 default]", 
+        type="float")
+
+    parser.add_option("--qcut", dest="qcut", default=0,
+        help="trim low-quality 3'-end bases below given quality"
+        "[0 default, no trim]", type="int")
+
+    parser.add_option("--polya", dest="polya", default=0,
+        help="trim polyA tail of at least given length[0 default, no trim]", 
+        type="int")
+
+    parser.add_option("--minlen", dest="minlen", default=0,
+        help="drop decoded reads shorter than given length after trimming"
+        "[0 default]", type="int")
+
+    parser.add_option("-z", "--gzip", action="store_true", dest="gzip",
+        default=False, help="write outputs compressed (.gz)")
+
+    parser.add_option("--max_open", dest="max_open", default=256,
+        help="maximum number of open output files[256 default]", type="int")
+
+    parser.add_option("--dry_run", dest="dry_run", default=0,
+        help="decode given number of randomly sampled reads without writing "
+        "Fastq files, stats written to outprefix.sample.json[0 default]", 
+        type="int")
+
+    parser.add_option("--seed", dest="seed", default=0,
+        help="random seed of --dry_run sampling[0 default]", type="int")
+
     parser.add_option("--outprefix", dest="outprefix", 
         help="out prefix", type="str")
 
@@ -50,6 +104,16 @@ def process_command_line(argv):
         parser.error("--outprefix required")
 
     # further process settings & args if necessary
+    if options.segments:
+        try:
+            options.segments = [tuple(map(int, seg.split(','))) 
+                for seg in options.segments]
+        except ValueError:
+            parser.error("--segment should be start,length,mismatch")
+        for seg in options.segments:
+            if len(seg) != 3:
+                parser.error("--segment should be start,length,mismatch")
+
     return options, args
 
 ################################################################################
@@ -64,10 +128,20 @@ if __name__ == '__main__':
     allowed_mismatch = options.mismatch
     
     barcode2name = read_barcode(file_barcode)
+    stages = make_stages(drop5=options.drop5, drop3=options.drop3, 
+        adapter=options.adapter, min_polya=options.polya, 
+        minlen=options.minlen, error_rate=options.error_rate, 
+        qual_cutoff=options.qcut)
     dc = create_decoder(infile, barcode2name, 
         mismatch=allowed_mismatch, startpos=options.startpos,
-        outprefix=options.outprefix)
+        outprefix=options.outprefix, compress=options.gzip,
+        max_open=options.max_open, segments=options.segments,
+        method=options.method, stages=stages, dry_run=options.dry_run > 0)
     
-    dc.decode()
+    if options.dry_run:
+        stats = dc.decode_sample(count=options.dry_run, seed=options.seed)
+        stats.write(options.outprefix+'.sample.json', barcode2name)
+    else:
+        dc.decode(threads=options.threads)
     
 ################################################################################
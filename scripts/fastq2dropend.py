@@ -6,6 +6,7 @@ Drop end bases of given length for Fastq format
 import os
 import sys
 import optparse
+from maps.io_utils.fastq import dropend_fastq
 
 ################################################################################
 
@@ -14,14 +15,14 @@ def process_command_line(argv):
         argv = sys.argv[1:]
 
     # initialize the parser object:
-    usage = "usage: %prog [options] infile.fastq"
+    usage = "usage: %prog [options] infile.fastq[.gz]"
     parser = optparse.OptionParser(usage,
         formatter=optparse.TitledHelpFormatter(width=78),
         add_help_option=None)
 
     # define options here:
     parser.add_option("-o", "--outfile", dest="outfile",
-        help="outfile name", metavar="FILE")
+        help="outfile name, compressed if ending with .gz", metavar="FILE")
 
     parser.add_option("-d", "--drop_len", dest="drop_len", default=0,
         help='number of nt to drop(default 0)', type="int")
@@ -29,6 +30,20 @@ def process_command_line(argv):
     parser.add_option("-e", "--end", dest="end", default=3,
         help='which end to drop: 5 or 3 (default 3)', type="int")    
 
+    parser.add_option("--drop5", dest="drop5", default=0,
+        help="number of nt to drop at 5'-end, with --drop3 to drop both ends"
+        "(default 0)", type="int")
+
+    parser.add_option("--drop3", dest="drop3", default=0,
+        help="number of nt to drop at 3'-end(default 0)", type="int")
+
+    parser.add_option("-m", "--minlen", dest="minlen", default=0,
+        help="drop reads shorter than given length after dropping end bases"
+        "(default 0)", type="int")
+
+    parser.add_option("-t", "--threads", dest="threads", default=1,
+        help="number of worker processes(default 1)", type="int")
+
     parser.add_option('-h', '--help', action='help',
         help='Show this help message and exit.')
 
@@ -50,31 +65,16 @@ if __name__ == '__main__':
     options, args = process_command_line(sys.argv)
     infile = args[1]
     assert os.path.exists(infile)
-    cut_len = options.drop_len
     
-    outhandle = sys.stdout
-    if options.outfile:
-        outhandle = open(options.outfile, 'w')
+    drop5 = options.drop5
+    drop3 = options.drop3
+    if options.end == 5:
+        drop5 += options.drop_len
+    else:
+        drop3 += options.drop_len
     
-    num_short = 0
-    i = 0
-    for line in open(infile):
-        i += 1
-        line = line.rstrip()
-        
-        if i % 2 == 0:
-            if len(line) < cut_len:
-                num_short += 1
-                
-            if options.end == 3:
-                line = line[:-cut_len]
-            elif options.end == 5:
-                line = line[cut_len:]
-                
-        outhandle.write(line+"\n")   
-        
-    sys.stderr.write("#shorter than cut_len(%d): %d\n" % (cut_len, num_short))
-
-    if options.outfile:
-        outhandle.close()
-           
+    nread, nshort = dropend_fastq(infile, options.outfile, drop5=drop5, 
+        drop3=drop3, minlen=options.minlen, threads=options.threads)
+    
+    sys.stderr.write("#shorter than minlen(%d): %d of %d\n" % (
+        options.minlen, nshort, nread))
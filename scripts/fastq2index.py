@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+"""
+Index Fastq format (uncompressed or BGZF) by offsets of every N-th record,
+index is saved to infile.fqi for random access and parallel splitting
+"""
+
+import os
+import sys
+import optparse
+from maps.io_utils.fastq import index_fastq
+
+################################################################################
+
+def process_command_line(argv):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    # initialize the parser object:
+    usage = "usage: %prog [options] infile.fastq[.gz]"
+    parser = optparse.OptionParser(usage,
+        formatter=optparse.TitledHelpFormatter(width=78),
+        add_help_option=None)
+
+    # define options here:
+    parser.add_option("-s", "--step", dest="step", default=1000,
+        help="index every given number of records(default 1000)", type="int")
+
+    parser.add_option("-o", "--outfile", dest="outfile",
+        help="index file name(default infile.fqi)", metavar="FILE")
+
+    parser.add_option('-h', '--help', action='help',
+        help='Show this help message and exit.')
+
+    (options, args) = parser.parse_args(argv)
+    if len(args) < 2:
+        parser.error(usage)
+
+    return options, args
+
+################################################################################
+
+if __name__ == '__main__':
+    options, args = process_command_line(sys.argv)
+    infile = args[1]
+    assert os.path.exists(infile)
+
+    index = index_fastq(infile, options.step, options.outfile)
+    sys.stderr.write("#records: %d, indexed: %d\n" % (index.nrecord, 
+        len(index.offsets)))
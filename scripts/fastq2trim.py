@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""
+Trim 3'-adaptor, polyA tail and low quality bases for Fastq format
+"""
+
+import os
+import sys
+import optparse
+from maps.io_utils.trimmer import Trimmer, trim_fastq
+
+################################################################################
+
+def process_command_line(argv):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    # initialize the parser object:
+    usage = "usage: %prog [options] infile.fastq[.gz]"
+    parser = optparse.OptionParser(usage,
+        formatter=optparse.TitledHelpFormatter(width=78),
+        add_help_option=None)
+
+    # define options here:
+    parser.add_option("-o", "--outfile", dest="outfile",
+        help="outfile name, compressed if ending with .gz", metavar="FILE")
+
+    parser.add_option("-a", "--adapter", dest="adapter",
+        help="3'-adaptor sequence", type="str")
+
+    parser.add_option("-e", "--error_rate", dest="error_rate", default=0.1,
+        help="maximum mismatch rate in adaptor match(default 0.1)", 
+        type="float")
+
+    parser.add_option("--polya", dest="polya", default=0,
+        help="trim polyA tail of at least given length(default 0, no trim)", 
+        type="int")
+
+    parser.add_option("-q", "--qcut", dest="qcut", default=0,
+        help="trim low-quality 3'-end bases below given quality"
+        "(default 0, no trim)", type="int")
+
+    parser.add_option("-m", "--minlen", dest="minlen", default=0,
+        help="drop reads shorter than given length(default 0)", type="int")
+
+    parser.add_option('-h', '--help', action='help',
+        help='Show this help message and exit.')
+
+    (options, args) = parser.parse_args(argv)
+    if len(args) < 2:
+        parser.error(usage)
+    if not options.outfile:
+        parser.error('--outfile required')
+
+    return options, args
+
+################################################################################
+
+if __name__ == '__main__':
+    options, args = process_command_line(sys.argv)
+    infile = args[1]
+    assert os.path.exists(infile)
+
+    trimmer = Trimmer(options.adapter, error_rate=options.error_rate,
+        min_polya=options.polya, qual_cutoff=options.qcut)
+    hists, nshort = trim_fastq(infile, options.outfile, trimmer, 
+        minlen=options.minlen)
+
+    sys.stderr.write("#shorter than minlen(%d): %d\n" % (options.minlen, nshort))
+    for name in sorted(hists):
+        for tlen in sorted(hists[name]):
+            sys.stderr.write("%s\t%d\t%d\n" % (name, tlen, hists[name][tlen]))
+
@@ -5,7 +5,7 @@ Compute expression in the defined landing intervals associated with counting uni
 
 import sys
 import optparse
-from maps.exp import DGE
+from maps.exp import DGE, DGEMatrix, COUNT_MODES, SPLIT_METHODS
 
 ################################################################################
 
@@ -13,7 +13,7 @@ def process_command_line(argv):
     if argv is None:
         argv = sys.argv[1:]
            
-    usage = "%s\nusage: prog [options] f_read f_gtf" % __doc__
+    usage = "%s\nusage: prog [options] f_read [f_read ...] f_gtf" % __doc__
     parser = optparse.OptionParser(usage, 
         formatter=optparse.TitledHelpFormatter(width=178),
         add_help_option=True)
@@ -25,12 +25,47 @@ def process_command_line(argv):
         default = "transcript_id", help = "GTF attribute as counting unit[transcript_id]")
 
     parser.add_option("-o", "--outfile", type="string", dest="outfile",
-        help = "out file name")
+        help = "out file name, or prefix of matrices of several f_read "
+        "(outfile.unique, outfile.shared, outfile.rpkm)")
+
+    parser.add_option("-n", "--threads", type="int", dest="threads",
+        default = 1, help = "number of worker processes counting chromosomes "
+        "of indexed f_read, or several f_read[1]")
+
+    parser.add_option("-m", "--mode", type="choice", dest="mode",
+        choices=COUNT_MODES, default="strict", help = "assign reads by "
+        "features of all aligned blocks (strict) or of the 3'-end base (end3)"
+        "[strict]")
+
+    parser.add_option("-s", "--split", type="choice", dest="split",
+        choices=SPLIT_METHODS, default="prior", help = "split shared reads "
+        "by unique reads of counting units in one step (prior) or by EM "
+        "of their abundance (em)[prior]")
+
+    parser.add_option("-q", "--mapq", type="int", dest="min_mapq",
+        default = 0, help = "skip reads of mapping quality less than this[0]")
+
+    parser.add_option("-F", "--exclude", type="int", dest="exclude_flags",
+        default = 0, help = "skip reads having any of these SAM flags, "
+        "e.g. 2304 for secondary and supplementary alignments[0]")
+
+    parser.add_option("-r", "--regions", action="store_true", dest="regions",
+        default = False, help = "read only regions of f_gtf features from "
+        "indexed f_read, other mapped reads are counted by the BAM index "
+        "(not with -q or -F)")
+
+    parser.add_option("--nocache", action="store_false", dest="cache",
+        default = True, help = "do not cache annotation of f_gtf "
+        "(by default cached to f_gtf.annot-<hash> at first use)")
 
     (options, args) = parser.parse_args()
    
-    if len(args) != 2:
+    if len(args) < 2:
         parser.error('No required parameters')
+    if options.regions and (options.min_mapq or options.exclude_flags):
+        parser.error('--regions can not be used with --mapq or --exclude')
+    if len(args) > 2 and not options.outfile:
+        parser.error('--outfile required for several f_read')
           
     return options, args
 
@@ -38,17 +73,32 @@ def process_command_line(argv):
 
 def main():
     options, args = process_command_line(None)
-    f_read = args[0]
-    f_gtf = args[1]
+    f_reads = args[:-1]
+    f_gtf = args[-1]
     
+    if len(f_reads) > 1:
+        matrix = DGEMatrix(f_reads, f_gtf, feature_type=options.featuretype, 
+            id_feature = "gene_id", id_count=options.unit, cache=options.cache,
+            mode=options.mode, min_mapq=options.min_mapq, 
+            exclude_flags=options.exclude_flags, regions=options.regions,
+            split=options.split)
+        matrix.count(threads=options.threads)
+        matrix.write(options.outfile)
+        return
+    
+    f_read = f_reads[0]
+
     dge = DGE(f_read, f_gtf, feature_type=options.featuretype, 
-        id_feature = "gene_id", id_count=options.unit)
+        id_feature = "gene_id", id_count=options.unit, cache=options.cache,
+        mode=options.mode, min_mapq=options.min_mapq, 
+        exclude_flags=options.exclude_flags, regions=options.regions,
+        split=options.split)
 
     outhandle = sys.stdout
     if options.outfile:
         outhandle = open(options.outfile, "w")
         
-    dge.count(outhandle)
+    dge.count(outhandle, threads=options.threads)
     
     if options.outfile:
         outhandle.close()
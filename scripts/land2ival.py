@@ -7,7 +7,7 @@ add gene names if a refFlat.bed is given
 import os
 import sys
 import optparse
-import HTSeq
+from maps.io_utils.gtf import reader_gtf
 
 ################################################################################
 
@@ -83,29 +83,25 @@ if __name__ == '__main__':
         assert os.path.exists(options.refFlat)
         gid2name = gene2name(f_bed, options.refFlat)
     
-    uid2ivals = {}
+    uid2ival = {}
     uid2names = {}
-    for f in HTSeq.GFF_Reader(f_gtf):
-        if f.type == options.featuretype:
-            gids = f.attr['gene_id'].split("|")
-            uid = f.attr[options.unit]
-            if uid not in uid2ivals:
-                uid2ivals[uid] = []
-            uid2ivals[uid].append(f.iv)
-            
-            if uid not in uid2names:
-                uid2names[uid] = set()
-            for gid in gids:
-                name = gid2name[gid]
-                if name:
-                    uid2names[uid].add(name)
+    for chrom, _, start, end, strand, (gid, uid) in reader_gtf(f_gtf, 
+            ('gene_id', options.unit), options.featuretype):
+        if uid not in uid2ival:
+            uid2ival[uid] = [chrom, start, end, strand]
+            uid2names[uid] = set()
+        else:
+            ival = uid2ival[uid]
+            ival[1] = min(ival[1], start)
+            ival[2] = max(ival[2], end)
+        
+        for gid in gid.split("|"):
+            name = gid2name[gid] if gid2name else ''
+            if name:
+                uid2names[uid].add(name)
     
     for uid in sorted(uid2names):
-        ivs = uid2ivals[uid]
-        chrom = ivs[0].chrom
-        strand = ivs[0].strand
-        start = min([iv.start for iv in ivs])
-        end = max([iv.end for iv in ivs])
+        chrom, start, end, strand = uid2ival[uid]
         outhandle.write("\t".join(map(str, [
             chrom, start, end, uid, "|".join(uid2names[uid]), strand]))+"\n")
         